@@ -4,6 +4,9 @@ SESSION = 'test'  # this value should be either 'test' or 'train'
 VERBOSE = True
 IMG_SIZE = (64, 64)
 SHAPE_PREDICTOR_PATH = "shape_predictor_68_face_landmarks.dat"
+LANDMARK_WORKERS = 0  # number of workers extracting dlib points, 0 extracts them in the calling thread
+LANDMARK_WORKER_TYPE = "thread"  # either "thread" or "process"
+LANDMARK_CACHE_DIR = None  # directory of the on-disk dlib points cache, None disables it
 
 # train
 BATCH_SIZE = 32  # Batch sized used for traing.
@@ -15,10 +18,34 @@ LOG_DIR = "logs"
 STEPS_PER_EPOCH = 640
 NETWORK_TYPE = "mi"  # mi for multi input or si for single input
 AUGMENTATION = True
+IMAGE_CACHE_BYTES = 0  # memory budget of the cache of sanitized train images in bytes, 0 disables it
+PREFETCH_WORKERS = 0  # number of workers building batches in the background, 0 builds them in the training loop
+PREFETCH_WORKER_TYPE = "thread"  # either "thread" or "process"
+PREFETCH_QUEUE_SIZE = 8  # maximum number of prefetched batches
+PREFETCH_SEED = None  # base seed of the prefetch workers, worker i uses PREFETCH_SEED + i
 
 # test
 MODEL_PATH = "models/minn/minn-0"  # model name used for testing
 TEST_IMAGE = '0.png'
 TEST_VIDEO = "C:/Users/Fabi/DataSets/75Emotions.mp4"
+TEST_VIDEO_OUTPUT = None  # annotated copy of TEST_VIDEO, not written if None
+TEST_VIDEO_PREDICTIONS = None  # json lines file of the per-frame predictions, not written if None
+VIDEO_BATCH_SIZE = 32  # maximum number of faces, gathered across frames, classified per forward pass
+DETECTION_SCALE = 1.0  # faces are detected on frames resized by this factor and cropped from the full frame
+FACE_TRACKING_INTERVAL = 0  # webcam: frames between two face detections, faces are tracked in between; 0 disables
+FACE_TRACKING_MIN_CONFIDENCE = 7.0  # webcam: tracker confidence under which the faces are detected again
+SEQUENCE_STRIDE = 1  # webcam drnn: new frames between two predictions on the rolling landmark window
+STREAMING_INFERENCE = False  # webcam drnn: step a stateful LSTM one frame at a time instead of rolling windows
+STREAMING_MAX_FACES = 8  # webcam drnn: number of faces the stateful LSTM follows at the same time
+INFERENCE_BACKEND = "keras"  # either "keras" or "tflite", tflite converts MODEL_PATH to MODEL_PATH.tflite if needed
+TFLITE_THREADS = 1  # number of cpu threads of the tflite interpreter
+STAGE_TIMING = False  # time the stages of the inference loop and report their p50/p95/p99 periodically
+STAGE_TIMING_INTERVAL = 10.0  # seconds between two stage timing reports
+STAGE_TIMING_OUTPUT = None  # json lines file of the stage timing reports, logged to stdout if None
+SERVER_HOST = "127.0.0.1"  # inference server: address listened on
+SERVER_PORT = 8000  # inference server: port listened on
+SERVER_UNIX_SOCKET = None  # inference server: unix socket path listened on instead of SERVER_HOST and SERVER_PORT
+SERVER_MAX_BATCH_SIZE = 32  # inference server: maximum number of faces classified per forward pass
+SERVER_MAX_WAIT_MS = 5  # inference server: time the first face of a batch waits for more faces
 """Test type either image,video or webcam"""
 TEST_TYPE = 'image'
@@ -1,34 +1,115 @@
 import argparse
+import importlib
 import os
+import sys
 
-from config import SESSION
-from runners import start_train_program, run_test
-from train_config import DATA_SET_DIR, EPOCHS, LEARNING_RATE, STEPS_PER_EPOCH, BATCH_SIZE, AUGMENTATION
+from config import SESSION, NETWORK_TYPE, DATA_SET_DIR, EPOCHS, LEARNING_RATE, STEPS_PER_EPOCH, BATCH_SIZE, \
+    AUGMENTATION
 
+# modules run by the convert and bench subcommands, the remaining arguments are parsed by their main function
+CONVERTERS = {"packed": "preprocess.packed", "tflite": "nets.tflite_backend", "int8": "nets.quantization"}
+BENCHMARKS = {"suite": "benchmarks.suite", "detection": "benchmarks.detection"}
 
-def main():
+
+def str2bool(value):
     """
 
+    Args:
+        value: command line value
+
+    Returns:
+        True for 1, true or yes
     """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--data_set_dir", default=DATA_SET_DIR, type=str)
-    parser.add_argument("--train", default=(SESSION == "train"), type=bool)
-    parser.add_argument("--epochs", default=EPOCHS, type=int)
-    parser.add_argument("--batch_size", default=BATCH_SIZE, type=int)
-    parser.add_argument("--lr", default=LEARNING_RATE, type=float)
-    parser.add_argument("--steps", default=STEPS_PER_EPOCH, type=int)
-    parser.add_argument("--augmentation", default=AUGMENTATION, type=bool)
+    return str(value).lower() in ["1", "true", "yes"]
 
-    args = parser.parse_args()
+
+def run_tool(module_name, args):
+    """
+    Imports module_name and runs its main function as if it was started with args.
+
+    Args:
+        module_name:
+        args: command line arguments of the tool
+    """
+    sys.argv = [module_name] + list(args)
+    importlib.import_module(module_name).main()
+
+
+def train(args):
+    """
+
+    Args:
+        args: parsed arguments of the train subcommand
+    """
     if not os.path.exists(args.data_set_dir):
         print("Data set path given does not exists")
         exit(0)
+    from runners import start_train_program
+    start_train_program(network_type=args.network_type, dataset_dir=args.data_set_dir, epochs=args.epochs,
+                        batch_size=args.batch_size, lr=args.lr, steps=args.steps, augmentation=args.augmentation)
+
+
+def test(args):
+    """
+
+    Args:
+        args: parsed arguments of the test subcommand
+    """
+    from runners import run_test
+    run_test()
+
+
+def main():
+    """
+    Subcommands:
+        train     trains the net of --network_type
+        test      runs the test session configured in config.py
+        convert   packed, tflite or int8 conversion, e.g. `convert packed --out packed`
+        bench     suite or detection benchmark, e.g. `bench suite --out results.json`
+        serve     micro-batching inference server, e.g. `serve --unix_socket /tmp/emopy.sock`
+
+    Without a subcommand the session set by SESSION in config.py is run. Only the modules of the chosen
+    subcommand and network type are imported, keras is not loaded by the conversions and benchmarks that
+    do not need a model.
+    """
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("--network_type", default=NETWORK_TYPE, type=str, choices=["mi", "si", "rnn", "drnn",
+                                                                                       "dinn"])
+    train_parser.add_argument("--data_set_dir", default=DATA_SET_DIR, type=str)
+    train_parser.add_argument("--epochs", default=EPOCHS, type=int)
+    train_parser.add_argument("--batch_size", default=BATCH_SIZE, type=int)
+    train_parser.add_argument("--lr", default=LEARNING_RATE, type=float)
+    train_parser.add_argument("--steps", default=STEPS_PER_EPOCH, type=int)
+    train_parser.add_argument("--augmentation", default=AUGMENTATION, type=str2bool)
+    train_parser.set_defaults(function=train)
+
+    test_parser = subparsers.add_parser("test")
+    test_parser.set_defaults(function=test)
 
-    if args.train == (SESSION == "train"):
-        start_train_program(dataset_dir=args.data_set_dir, epochs=args.epochs, batch_size=args.batch_size, lr=args.lr,
-                            steps=args.steps, augmentation=AUGMENTATION)
-    else:
-        run_test()
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("target", choices=sorted(CONVERTERS.keys()))
+    convert_parser.add_argument("tool_args", nargs=argparse.REMAINDER)
+    convert_parser.set_defaults(function=lambda args: run_tool(CONVERTERS[args.target], args.tool_args))
+
+    bench_parser = subparsers.add_parser("bench")
+    bench_parser.add_argument("benchmark", choices=sorted(BENCHMARKS.keys()))
+    bench_parser.add_argument("tool_args", nargs=argparse.REMAINDER)
+    bench_parser.set_defaults(function=lambda args: run_tool(BENCHMARKS[args.benchmark], args.tool_args))
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("tool_args", nargs=argparse.REMAINDER)
+    serve_parser.set_defaults(function=lambda args: run_tool("inference_server", args.tool_args))
+
+    args = parser.parse_args()
+    if args.command is None:
+        if SESSION == "train":
+            args = train_parser.parse_args([])
+        else:
+            args = test_parser.parse_args([])
+    args.function(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,3 @@
+"""
+Benchmarks of the data, feature extraction and inference stages.
+"""
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Latency and recall of face detection on downscaled frames.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import cv2
+import dlib
+import numpy as np
+
+from config import IMG_SIZE
+from preprocess.base import Preprocessor
+from preprocess.tracking import overlap
+from util import SevenEmotionsClassifier
+
+
+def recall(reference, detections, min_overlap=0.5):
+    """
+
+    Args:
+        reference: rectangles found at full resolution
+        detections: rectangles found at a lower scale, mapped back to full resolution
+        min_overlap: intersection over union for a reference face to count as found
+
+    Returns:
+        number of reference faces matched by a detection
+    """
+    found = 0
+    unmatched = list(detections)
+    for rectangle in reference:
+        overlaps = [overlap(rectangle, detection) for detection in unmatched]
+        if len(overlaps) > 0 and max(overlaps) >= min_overlap:
+            unmatched.pop(int(np.argmax(overlaps)))
+            found += 1
+    return found
+
+
+def benchmark_detection_scales(frames, scales, detector=None):
+    """
+
+    Args:
+        frames: list of BGR frames
+        scales: detection scales to compare, the full resolution is always measured as reference
+        detector: defaults to dlib.get_frontal_face_detector()
+
+    Returns:
+        dict mapping each scale to its mean and p95 latency in ms, its recall and number of faces found
+    """
+    if detector is None:
+        detector = dlib.get_frontal_face_detector()
+    preprocessor = Preprocessor(SevenEmotionsClassifier(), input_shape=(IMG_SIZE[0], IMG_SIZE[1], 1))
+    scales = [1.0] + [scale for scale in scales if scale != 1.0]
+    reference = []
+    results = {}
+    for scale in scales:
+        latencies = []
+        found = 0
+        detected = 0
+        for i, frame in enumerate(frames):
+            start = time.time()
+            rectangles = preprocessor.detect_faces(frame, detector, scale)
+            latencies.append((time.time() - start) * 1000)
+            if scale == 1.0:
+                reference.append(rectangles)
+            found += recall(reference[i], rectangles)
+            detected += len(rectangles)
+        number_of_reference_faces = sum(len(rectangles) for rectangles in reference)
+        results[str(scale)] = {
+            "latency_ms_mean": float(np.mean(latencies)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "recall": found / float(number_of_reference_faces) if number_of_reference_faces > 0 else None,
+            "faces": detected,
+        }
+        print("scale", scale, results[str(scale)])
+    return results
+
+
+def read_frames(images_dir=None, video_path=None, max_frames=200):
+    """
+
+    Args:
+        images_dir: directory of images
+        video_path: video file, used if images_dir is None
+        max_frames:
+
+    Returns:
+        list of BGR frames
+    """
+    frames = []
+    if images_dir is not None:
+        for img_file in sorted(os.listdir(images_dir))[:max_frames]:
+            frame = cv2.imread(os.path.join(images_dir, img_file))
+            if frame is not None:
+                frames.append(frame)
+    else:
+        cap = cv2.VideoCapture(video_path)
+        while cap.isOpened() and len(frames) < max_frames:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames
+
+
+def main():
+    """
+    Compares the detection scales on the frames of an image directory or a video.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", default=None, type=str)
+    parser.add_argument("--video", default=None, type=str)
+    parser.add_argument("--scales", default=[0.75, 0.5, 0.25], type=float, nargs="+")
+    parser.add_argument("--max_frames", default=200, type=int)
+    parser.add_argument("--out", default=None, type=str)
+
+    args = parser.parse_args()
+    assert args.images is not None or args.video is not None, "Either --images or --video is required"
+    results = benchmark_detection_scales(read_frames(args.images, args.video, args.max_frames), args.scales)
+    if args.out is not None:
+        with open(args.out, "w") as out_file:
+            json.dump(results, out_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# coding=utf-8
+"""
+Throughput and latency of the data, feature extraction and inference stages on synthetic data, with a comparison
+of the results against a baseline run.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import dlib
+import numpy as np
+
+from benchmarks.synthetic import write_dataset, generate_faces, generate_landmarks
+from config import IMG_SIZE, SHAPE_PREDICTOR_PATH, NETWORK_TYPE, MODEL_PATH
+from preprocess.base import Preprocessor
+from preprocess.feature_extraction import DlibFeatureExtractor
+from util import SevenEmotionsClassifier
+from util.model_registry import lazy_model
+
+
+def summarize(latencies):
+    """
+
+    Args:
+        latencies: durations in seconds
+
+    Returns:
+        dict of the mean, p50, p95 and p99 in ms
+    """
+    latencies = np.asarray(latencies) * 1000
+    return {"mean_ms": float(np.mean(latencies)), "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)), "p99_ms": float(np.percentile(latencies, 99))}
+
+
+def time_calls(function, repeats, warmup=1):
+    """
+
+    Args:
+        function: called without arguments
+        repeats:
+        warmup: calls made before timing
+
+    Returns:
+        list of the durations of the timed calls in seconds
+    """
+    for _ in range(warmup):
+        function()
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.time()
+        function()
+        latencies.append(time.time() - start_time)
+    return latencies
+
+
+def bench_sanitize(preprocessor, images, repeats=5):
+    """
+
+    Args:
+        preprocessor:
+        images: BGR faces
+        repeats:
+
+    Returns:
+        sanitize latency per image
+    """
+    latencies = time_calls(lambda: [preprocessor.sanitize(image) for image in images], repeats)
+    return summarize(np.asarray(latencies) / len(images))
+
+
+def bench_get_images(preprocessor, paths, repeats=5):
+    """
+
+    Args:
+        preprocessor:
+        paths: image files
+        repeats:
+
+    Returns:
+        get_images latency per image, decoding included
+    """
+    latencies = time_calls(lambda: preprocessor.get_images(paths), repeats)
+    return summarize(np.asarray(latencies) / len(paths))
+
+
+def bench_flow(preprocessor, number_of_batches=20):
+    """
+
+    Args:
+        preprocessor: called preprocessor
+        number_of_batches:
+
+    Returns:
+        dict with the batches and images per second of the flow
+    """
+    flow = preprocessor.flow()
+    next(flow)
+    start_time = time.time()
+    for _ in range(number_of_batches):
+        next(flow)
+    elapsed = time.time() - start_time
+    return {"batches_per_s": number_of_batches / elapsed,
+            "images_per_s": number_of_batches * preprocessor.batch_size / elapsed}
+
+
+def bench_geometry(landmarks, repeats=5):
+    """
+
+    Args:
+        landmarks: array of shape (N, 68, 2)
+        repeats:
+
+    Returns:
+        latency per face of the distances, angles and normalization computed from dlib points
+    """
+    extractor = DlibFeatureExtractor(None)
+    latencies = time_calls(lambda: extractor.get_geometry(landmarks), repeats)
+    return summarize(np.asarray(latencies) / len(landmarks))
+
+
+def bench_extract(faces, repeats=3):
+    """
+
+    Args:
+        faces: sanitized faces of size IMG_SIZE
+        repeats:
+
+    Returns:
+        DlibFeatureExtractor.extract latency per image, None if the shape predictor is missing
+    """
+    if not os.path.exists(SHAPE_PREDICTOR_PATH):
+        print("Skipping extract benchmark,", SHAPE_PREDICTOR_PATH, "not found")
+        return None
+    extractor = DlibFeatureExtractor(dlib.shape_predictor(SHAPE_PREDICTOR_PATH))
+    faces = faces.reshape(-1, IMG_SIZE[0], IMG_SIZE[1], 1)
+    latencies = time_calls(lambda: extractor.extract(faces), repeats)
+    extractor.close()
+    return summarize(np.asarray(latencies) / len(faces))
+
+
+def bench_predict(model_path, batch_sizes=(1, 32), repeats=50, random_state=None):
+    """
+
+    Args:
+        model_path: path of the model without the .json and .h5 extensions
+        batch_sizes:
+        repeats:
+        random_state:
+
+    Returns:
+        dict mapping each batch size to its predict latency, None if the model files are missing
+    """
+    if not os.path.exists(model_path + ".json") or not os.path.exists(model_path + ".h5"):
+        print("Skipping predict benchmark,", model_path, "not found")
+        return None
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    model = lazy_model(model_path)
+    input_shapes = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+    results = {}
+    for batch_size in batch_sizes:
+        inputs = [random_state.rand(batch_size, *shape[1:]).astype(np.float32) for shape in input_shapes]
+        inputs = inputs if len(inputs) > 1 else inputs[0]
+        results[str(batch_size)] = summarize(time_calls(lambda: model.predict(inputs, batch_size=batch_size),
+                                                        repeats))
+    return results
+
+
+def run_suite(work_dir, models, images_per_emotion=20, seed=0):
+    """
+
+    Args:
+        work_dir: directory receiving the synthetic data set
+        models: dict mapping network types to model paths
+        images_per_emotion: train images per emotion, a quarter as many test images are written
+        seed:
+
+    Returns:
+        dict of the results of every benchmark
+    """
+    random_state = np.random.RandomState(seed)
+    data_set_dir = write_dataset(os.path.join(work_dir, "data"), images_per_emotion,
+                                 max(1, images_per_emotion // 4), seed=seed)
+    classifier = SevenEmotionsClassifier()
+    input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
+    preprocessor = Preprocessor(classifier, input_shape=input_shape)
+    faces = generate_faces(64, random_state=random_state)
+    paths = np.array([os.path.join(data_set_dir, "train", classifier.get_string(0), str(i) + ".png")
+                      for i in range(min(images_per_emotion, 64))])
+
+    flow_preprocessor = Preprocessor(classifier, input_shape=input_shape)
+    flow_preprocessor(data_set_dir)
+    augmented_flow_preprocessor = Preprocessor(classifier, input_shape=input_shape, augmentation=True)
+    augmented_flow_preprocessor(data_set_dir)
+
+    results = {"sanitize": bench_sanitize(preprocessor, faces),
+               "get_images": bench_get_images(preprocessor, paths),
+               "geometry": bench_geometry(generate_landmarks(256, IMG_SIZE, random_state)),
+               "extract": bench_extract(np.array([preprocessor.sanitize(face) for face in faces])),
+               "flow": bench_flow(flow_preprocessor),
+               "flow_augmented": bench_flow(augmented_flow_preprocessor),
+               "predict": {}}
+    for network_type, model_path in sorted(models.items()):
+        results["predict"][network_type] = bench_predict(model_path, random_state=random_state)
+    return results
+
+
+def flatten(results, prefix=""):
+    """
+
+    Args:
+        results: nested dict of results
+        prefix:
+
+    Returns:
+        dict mapping "benchmark.metric" keys to numbers
+    """
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Relative change of every metric present in both runs. Metrics ending in _per_s are better when higher,
+    latencies are better when lower.
+
+    Args:
+        results:
+        baseline:
+        tolerance: relative change beyond which a worse metric counts as a regression
+
+    Returns:
+        list of (metric, baseline value, value, relative change, regressed)
+    """
+    current = flatten(results)
+    previous = flatten(baseline)
+    rows = []
+    for name in sorted(set(current) & set(previous)):
+        if previous[name] == 0:
+            continue
+        change = (current[name] - previous[name]) / float(previous[name])
+        worse = -change if name.endswith("_per_s") else change
+        rows.append((name, previous[name], current[name], change, worse > tolerance))
+    return rows
+
+
+def main():
+    """
+    Runs the suite, writes its results and compares them with a baseline results file.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work_dir", default=None, type=str, help="synthetic data directory, temporary if None")
+    parser.add_argument("--images_per_emotion", default=20, type=int)
+    parser.add_argument("--models", default=[], type=str, nargs="*",
+                        help="network_type=model_path pairs, e.g. mi=models/minn/minn-0, MODEL_PATH if none")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str, help="json file receiving the results")
+    parser.add_argument("--baseline", default=None, type=str, help="results json of a previous run")
+    parser.add_argument("--tolerance", default=0.1, type=float)
+    args = parser.parse_args()
+
+    models = dict(model.split("=", 1) for model in args.models)
+    if len(models) == 0:
+        models = {NETWORK_TYPE: MODEL_PATH}
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="emopy-bench-")
+    try:
+        results = run_suite(work_dir, models, args.images_per_emotion, args.seed)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+    print(json.dumps(results, indent=4))
+    if args.out is not None:
+        with open(args.out, "w") as out_file:
+            json.dump({"time": time.time(), "opencv": cv2.__version__, "results": results}, out_file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = 0
+        for name, previous, value, change, regressed in compare(results, baseline, args.tolerance):
+            regressions += regressed
+            print("{:<40} {:>12.4f} {:>12.4f} {:>+8.1%}{}".format(name, previous, value, change,
+                                                                 "  REGRESSION" if regressed else ""))
+        if regressions > 0:
+            print(regressions, "metrics regressed by more than", str(int(args.tolerance * 100)) + "%")
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Synthetic faces and landmarks, so the benchmarks run without the CK+ data set.
+"""
+import os
+
+import cv2
+import numpy as np
+
+from util import SevenEmotionsClassifier
+
+
+def generate_faces(number_of_faces, image_size=(96, 96), random_state=None):
+    """
+    Draws blurred noise with a face-like ellipse, eyes and mouth at jittered positions. The images only need to
+    cost the same to decode, resize and augment as real faces, not to look like them.
+
+    Args:
+        number_of_faces:
+        image_size: (height, width)
+        random_state: numpy RandomState
+
+    Returns:
+        uint8 array of shape (number_of_faces, height, width, 3)
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    height, width = image_size
+    faces = np.empty((number_of_faces, height, width, 3), dtype=np.uint8)
+    for i in range(number_of_faces):
+        face = random_state.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        face = cv2.GaussianBlur(face, (9, 9), 0)
+        center = (width // 2 + random_state.randint(-width // 10, width // 10 + 1),
+                  height // 2 + random_state.randint(-height // 10, height // 10 + 1))
+        skin = tuple(int(value) for value in random_state.randint(120, 230, 3))
+        cv2.ellipse(face, center, (width // 3, int(height / 2.4)), 0, 0, 360, skin, -1)
+        for side in [-1, 1]:
+            cv2.circle(face, (center[0] + side * width // 7, center[1] - height // 10), max(1, width // 24),
+                       (40, 40, 40), -1)
+        mouth_height = random_state.randint(1, max(2, height // 12))
+        cv2.ellipse(face, (center[0], center[1] + height // 5), (width // 8, mouth_height), 0, 0, 360,
+                    (60, 50, 120), -1)
+        faces[i] = face
+    return faces
+
+
+def write_dataset(output_dir, train_images_per_emotion=20, test_images_per_emotion=5, image_size=(96, 96),
+                  classifier=None, seed=0):
+    """
+    Writes random faces in the train/<emotion> and test/<emotion> layout read by Preprocessor.load_dataset.
+
+    Args:
+        output_dir:
+        train_images_per_emotion:
+        test_images_per_emotion:
+        image_size:
+        classifier: defines the emotion directories, SevenEmotionsClassifier by default
+        seed:
+
+    Returns:
+        output_dir
+    """
+    if classifier is None:
+        classifier = SevenEmotionsClassifier()
+    random_state = np.random.RandomState(seed)
+    for split, images_per_emotion in [("train", train_images_per_emotion), ("test", test_images_per_emotion)]:
+        for emotion in range(classifier.get_num_class()):
+            emotion_dir = os.path.join(output_dir, split, classifier.get_string(emotion))
+            if not os.path.exists(emotion_dir):
+                os.makedirs(emotion_dir)
+            for i, face in enumerate(generate_faces(images_per_emotion, image_size, random_state)):
+                cv2.imwrite(os.path.join(emotion_dir, str(i) + ".png"), face)
+    return output_dir
+
+
+def generate_landmarks(number_of_faces, image_size=(64, 64), random_state=None):
+    """
+    68 dlib-like points per face: a jaw arc, brows, nose, eyes and mouth around the image center, scaled,
+    shifted and jittered per face.
+
+    Args:
+        number_of_faces:
+        image_size: (height, width) of the images the points lie in
+        random_state: numpy RandomState
+
+    Returns:
+        float array of shape (number_of_faces, 68, 2) of (x, y) points
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    jaw = np.linspace(np.pi, 2 * np.pi, 17)
+    template = np.concatenate([
+        np.stack([np.cos(jaw) * 0.4, -np.sin(jaw) * 0.45], axis=1),
+        np.stack([np.linspace(-0.3, -0.05, 5), np.full(5, -0.2)], axis=1),
+        np.stack([np.linspace(0.05, 0.3, 5), np.full(5, -0.2)], axis=1),
+        np.stack([np.zeros(4), np.linspace(-0.1, 0.1, 4)], axis=1),
+        np.stack([np.linspace(-0.08, 0.08, 5), np.full(5, 0.12)], axis=1),
+        np.stack([np.cos(np.linspace(0, 2 * np.pi, 7)[:-1]) * 0.08 - 0.17,
+                  np.sin(np.linspace(0, 2 * np.pi, 7)[:-1]) * 0.03 - 0.1], axis=1),
+        np.stack([np.cos(np.linspace(0, 2 * np.pi, 7)[:-1]) * 0.08 + 0.17,
+                  np.sin(np.linspace(0, 2 * np.pi, 7)[:-1]) * 0.03 - 0.1], axis=1),
+        np.stack([np.cos(np.linspace(0, 2 * np.pi, 13)[:-1]) * 0.15,
+                  np.sin(np.linspace(0, 2 * np.pi, 13)[:-1]) * 0.05 + 0.25], axis=1),
+        np.stack([np.cos(np.linspace(0, 2 * np.pi, 9)[:-1]) * 0.1,
+                  np.sin(np.linspace(0, 2 * np.pi, 9)[:-1]) * 0.02 + 0.25], axis=1),
+    ])
+    height, width = image_size
+    scales = random_state.uniform(0.8, 1.1, (number_of_faces, 1, 1)) * np.array([width, height])
+    shifts = random_state.uniform(-0.05, 0.05, (number_of_faces, 1, 2)) * np.array([width, height])
+    jitter = random_state.normal(0, 0.01, (number_of_faces, 68, 2)) * np.array([width, height])
+    return template * scales + np.array([width, height]) / 2.0 + shifts + jitter
@@ -1,101 +1,315 @@
 # coding=utf-8
+"""
+Converts the CK+ image folders to the train/test folder structure of the preprocessor.
+
+The peak image of every labeled sequence is hardlinked, reflinked or, where neither is possible, copied to
+`out/train/<emotion>` or `out/test/<emotion>`. Sequences are scanned by a thread pool and recorded in
+`out/ck_manifest.json`, so a re-run only stats the sequences and relinks the ones whose image, label or split
+changed. The test images are chosen by a seeded hash of the sequence names, stored in the manifest with the seed.
+"""
+from __future__ import print_function
+
 import argparse
-import glob
+import hashlib
+import json
 import os
-import random
 import shutil
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 CK_DIR = "C:/Users/Fabi/DataSets/CK/images"
-TRAIN_OUT_DIR = "C:/Users/Fabi/DataSets/CK/EmoPyData/train"
+OUT_DIR = "C:/Users/Fabi/DataSets/CK/EmoPyData"
 
+EMOTIONS = ["anger", "neutral", "disgust", "fear", "happy", "sad", "surprise"]
+MANIFEST_NAME = "ck_manifest.json"
+FICLONE = 0x40049409  # linux ioctl cloning a file into another of the same copy on write file system
+LINK_METHODS = {"auto": ("hardlink", "reflink"), "hardlink": ("hardlink",), "reflink": ("reflink",), "copy": ()}
 
-def create_folder_structure():
+
+def get_label(emotion_path):
     """
-    Create the folder structure needed by the preprocessor
+
+    Args:
+        emotion_path: path of a *_emotion.txt file
+
+    Returns:
+        emotion name of its code, undef for unknown codes
     """
-    if not os.path.exists(TRAIN_OUT_DIR):
-        os.mkdir(TRAIN_OUT_DIR)
+    with open(emotion_path) as emotion_file:
+        emotion = int(float(emotion_file.read().strip()))
+    if 1 <= emotion <= len(EMOTIONS):
+        return EMOTIONS[emotion - 1]
+    return "undef"
 
-    for sdir in os.listdir(CK_DIR):
-        spath = os.path.join(CK_DIR, sdir)
-        for ddir in os.listdir(spath):
-            dpath = os.path.join(spath, ddir)
-            if os.path.isdir(dpath):
-                os.chdir(dpath)
-            else:
-                print("not a dir:", dpath)
-            emotion_txt = glob.glob('*emotion*')
-            if len(emotion_txt) == 1:
-                add_emotion(os.path.join(dpath, emotion_txt[0]))
-            elif len(emotion_txt) > 1:
-                print(emotion_txt)
-    test()
-
-
-def add_emotion(path):
-    """
-        Copies the image in the correct folder according to the label
-
-    :param path: Path of the emotion.txt file to be appended to the data set
-    """
-    emotion_txt = os.open(path, os.O_RDONLY)
-    emotion = int(os.read(emotion_txt, 4))
-
-    if emotion == 1:
-        label = 'anger'
-    elif emotion == 2:
-        label = 'neutral'
-    elif emotion == 3:
-        label = 'disgust'
-    elif emotion == 4:
-        label = 'fear'
-    elif emotion == 5:
-        label = 'happy'
-    elif emotion == 6:
-        label = 'sad'
-    elif emotion == 7:
-        label = 'surprise'
+
+def scan_sequence(ck_dir, sequence, previous=None):
+    """
+    Finds the peak image and label of a sequence. The emotion file is only read again if it changed since the
+    previous scan.
+
+    Args:
+        ck_dir:
+        sequence: subject/sequence path relative to ck_dir
+        previous: manifest entry of the sequence from the previous run, or None
+
+    Returns:
+        manifest entry of the sequence, None if it has no single emotion file or no peak image
+    """
+    sequence_dir = os.path.join(ck_dir, sequence)
+    emotion_txt = [name for name in os.listdir(sequence_dir) if "emotion" in name]
+    if len(emotion_txt) != 1:
+        if len(emotion_txt) > 1:
+            print(emotion_txt)
+        return None
+    emotion_path = os.path.join(sequence_dir, emotion_txt[0])
+    image = "_".join(emotion_txt[0].split("_")[:3]) + ".png"
+    try:
+        image_stat = os.stat(os.path.join(sequence_dir, image))
+    except OSError:
+        print("no peak image:", os.path.join(sequence_dir, image))
+        return None
+    emotion_stat = os.stat(emotion_path)
+
+    entry = {"sequence": sequence, "emotion_file": emotion_txt[0], "emotion_mtime": emotion_stat.st_mtime,
+             "image": image, "size": image_stat.st_size, "mtime": image_stat.st_mtime}
+    if previous is not None and all(previous.get(key) == entry[key] for key in ["emotion_file", "emotion_mtime"]):
+        entry["label"] = previous["label"]
     else:
-        label = "undef"
+        entry["label"] = get_label(emotion_path)
+    return entry
+
+
+def list_sequences(ck_dir, pool):
+    """
+
+    Args:
+        ck_dir:
+        pool: pool listing the subject directories
+
+    Returns:
+        sorted subject/sequence paths relative to ck_dir
+    """
+    subjects = [subject for subject in sorted(os.listdir(ck_dir)) if os.path.isdir(os.path.join(ck_dir, subject))]
 
-    parts = path.split("_")
-    img_path = '.'.join(("_".join(parts[:3]), 'png'))
-    img_name = os.path.basename(img_path)
-    dst_path = os.path.join(TRAIN_OUT_DIR, label)
+    def list_subject(subject):
+        sequences = []
+        for sequence in sorted(os.listdir(os.path.join(ck_dir, subject))):
+            if os.path.isdir(os.path.join(ck_dir, subject, sequence)):
+                sequences.append(subject + "/" + sequence)
+            else:
+                print("not a dir:", os.path.join(ck_dir, subject, sequence))
+        return sequences
 
-    if not os.path.exists(dst_path):
-        os.mkdir(dst_path)
+    return [sequence for sequences in pool.map(list_subject, subjects) for sequence in sequences]
 
-    shutil.copy(img_path, os.path.join(dst_path, img_name))
 
+def split_rank(sequence, seed):
+    """
 
-def test():
+    Args:
+        sequence:
+        seed:
+
+    Returns:
+        sort key of the sequence in the test selection, the same for a seed whatever the other sequences are
     """
-        choose and copy test 7 images
+    return hashlib.sha1((str(seed) + ":" + sequence).encode("utf-8")).hexdigest()
+
+
+def assign_splits(entries, test_per_emotion=1, seed=0):
     """
-    above = os.path.join(TRAIN_OUT_DIR, '..')
-    os.chdir(above)
-    if not os.path.exists("test"):
-        os.mkdir("test")
+    Puts the `test_per_emotion` lowest ranked sequences of every emotion in the test split, keeping at least one
+    sequence per emotion for training. Adding sequences only changes the test selection if they rank lower.
 
-    for dir in os.listdir(TRAIN_OUT_DIR):
-        cur_dir = os.path.join(TRAIN_OUT_DIR, dir)
-        list_curr_dir = os.listdir(cur_dir)
-        random.seed()
-        rand_num = random.randint(0, len(list_curr_dir) - 1)
-        rand_img = list_curr_dir[rand_num]
-        rand_img_path = os.path.join(cur_dir, rand_img)
-        dst_path = os.path.join("test", dir)
-        if not os.path.exists(dst_path):
-            os.mkdir(dst_path)
+    Args:
+        entries: manifest entries of the sequences, given a split key
+        test_per_emotion:
+        seed:
+    """
+    labels = {}
+    for entry in entries:
+        labels.setdefault(entry["label"], []).append(entry)
+    for label_entries in labels.values():
+        label_entries.sort(key=lambda label_entry: split_rank(label_entry["sequence"], seed))
+        number_of_tests = min(test_per_emotion, len(label_entries) - 1)
+        for i, entry in enumerate(label_entries):
+            entry["split"] = "test" if i < number_of_tests else "train"
 
-        shutil.move(rand_img_path, os.path.join(dst_path, os.path.basename(rand_img_path)))
 
+def reflink(source, destination):
+    """
+    Clones source into destination, sharing their blocks until one of them is written.
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--ck", default=CK_DIR, type=str)
-    parser.add_argument("--out", default=TRAIN_OUT_DIR, type=str)
+    Args:
+        source:
+        destination:
+    """
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(source, "rb") as source_file:
+        with open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def link_file(source, destination, method="auto"):
+    """
+    Makes destination a hardlink or reflink of source, or a copy if the file system supports neither. Hardlinks
+    share the file with the data set, images must not be edited in place in the output folders.
+
+    Args:
+        source:
+        destination: replaced if it exists
+        method: auto, hardlink, reflink or copy; auto tries a hardlink then a reflink
+
+    Returns:
+        hardlink, reflink or copy, the method used
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    for link_method in LINK_METHODS[method]:
+        try:
+            if link_method == "hardlink":
+                os.link(source, destination)
+            else:
+                reflink(source, destination)
+            return link_method
+        except (OSError, IOError, AttributeError):
+            continue
+    shutil.copy(source, destination)
+    return "copy"
 
+
+def is_unchanged(entry, previous):
+    """
+
+    Args:
+        entry: manifest entry of the current scan
+        previous: manifest entry of the previous run, or None
+
+    Returns:
+        True if the output of the previous run is still up to date
+    """
+    if previous is None:
+        return False
+    if any(previous.get(key) != entry[key] for key in ["image", "size", "mtime", "label", "output"]):
+        return False
+    return os.path.exists(entry["output"])
+
+
+def load_manifest(manifest_path):
+    """
+
+    Args:
+        manifest_path:
+
+    Returns:
+        the manifest, an empty one if the file does not exist
+    """
+    if not os.path.exists(manifest_path):
+        return {"sequences": {}}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(manifest, manifest_path):
+    """
+    Writes the manifest to a temporary file first, an interrupted run keeps the previous manifest.
+
+    Args:
+        manifest:
+        manifest_path:
+    """
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temporary_path, manifest_path)
+
+
+def create_folder_structure(ck_dir=CK_DIR, out_dir=OUT_DIR, test_per_emotion=1, seed=0, method="auto", workers=16):
+    """
+    Create the folder structure needed by the preprocessor, updating the one of a previous run.
+
+    Args:
+        ck_dir: CK+ images directory holding the subject directories
+        out_dir: data set directory receiving the train and test directories and the manifest
+        test_per_emotion: test images per emotion
+        seed: seed of the test selection
+        method: auto, hardlink, reflink or copy
+        workers: threads scanning and linking, they mostly wait for the file system
+
+    Returns:
+        dict counting the scanned, linked, unchanged and removed images and the link methods used
+    """
+    assert method in LINK_METHODS, "Unknown link method " + method
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    previous = manifest["sequences"] if manifest.get("ck_dir") == os.path.abspath(ck_dir) else {}
+
+    pool = ThreadPool(workers)
+    try:
+        sequences = list_sequences(ck_dir, pool)
+        entries = [entry for entry in pool.map(lambda sequence: scan_sequence(ck_dir, sequence,
+                                                                              previous.get(sequence)), sequences)
+                   if entry is not None]
+        assign_splits(entries, test_per_emotion, seed)
+        for entry in entries:
+            entry["output"] = os.path.join(out_dir, entry["split"], entry["label"], entry["image"])
+        current = {entry["sequence"]: entry for entry in entries}
+
+        removed = 0
+        for sequence, previous_entry in previous.items():
+            output = previous_entry["output"]
+            if (sequence not in current or current[sequence]["output"] != output) and os.path.lexists(output):
+                os.remove(output)
+                removed += 1
+
+        changed = [entry for entry in entries if not is_unchanged(entry, previous.get(entry["sequence"]))]
+        for output_dir in set(os.path.dirname(entry["output"]) for entry in changed):
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+        methods = pool.map(lambda entry: link_file(os.path.join(ck_dir, entry["sequence"], entry["image"]),
+                                                   entry["output"], method), changed)
+    finally:
+        pool.close()
+        pool.join()
+
+    for entry, link_method in zip(changed, methods):
+        entry["method"] = link_method
+    for entry in entries:
+        if "method" not in entry:
+            entry["method"] = previous[entry["sequence"]].get("method")
+    write_manifest({"ck_dir": os.path.abspath(ck_dir), "seed": seed, "test_per_emotion": test_per_emotion,
+                    "time": time.time(), "sequences": current}, manifest_path)
+
+    counts = {"scanned": len(entries), "linked": len(changed), "unchanged": len(entries) - len(changed),
+              "removed": removed}
+    for link_method in methods:
+        counts[link_method] = counts.get(link_method, 0) + 1
+    print(", ".join(key + ": " + str(value) for key, value in sorted(counts.items())))
+    return counts
+
+
+def main():
+    """
+    Converts the data set given on the command line.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ck", default=CK_DIR, type=str, help="CK+ images directory")
+    parser.add_argument("--out", default=OUT_DIR, type=str, help="data set directory receiving train and test")
+    parser.add_argument("--test_per_emotion", default=1, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--link", default="auto", type=str, choices=sorted(LINK_METHODS.keys()))
+    parser.add_argument("--workers", default=16, type=int)
     args = parser.parse_args()
-    create_folder_structure()
+    create_folder_structure(args.ck, args.out, args.test_per_emotion, args.seed, args.link, args.workers)
+
+
+if __name__ == "__main__":
+    main()
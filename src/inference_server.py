@@ -0,0 +1,413 @@
+"""
+Local inference server sharing one NeuralNet between clients, whose single-face requests are gathered into
+micro-batches classified with one forward pass.
+
+POST /predict with an encoded image of a face (png, jpg, ...) as body answers
+{"emotion": ..., "probabilities": [...]}; GET /metrics answers the batching metrics.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+
+from config import IMG_SIZE, NETWORK_TYPE, MODEL_PATH, INFERENCE_BACKEND, SERVER_HOST, SERVER_PORT, \
+    SERVER_UNIX_SOCKET, SERVER_MAX_BATCH_SIZE, SERVER_MAX_WAIT_MS
+from util import SevenEmotionsClassifier
+from util.stage_timing import LatencyHistogram
+
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+
+class BatcherStopped(Exception):
+    """
+    Raised to the callers whose faces were not classified because the batcher stopped.
+    """
+    pass
+
+
+def read_body(request_handler):
+    """
+
+    Args:
+        request_handler: BaseHTTPRequestHandler of the request
+
+    Returns:
+        body of the request
+
+    Raises:
+        ValueError: if Content-Length is missing or not a number, or the body is empty or shorter
+    """
+    try:
+        length = int(request_handler.headers.get("Content-Length", ""))
+    except ValueError:
+        raise ValueError("Content-Length header is missing or not a number")
+    if length <= 0:
+        raise ValueError("Body is empty")
+    body = request_handler.rfile.read(length)
+    if len(body) < length:
+        raise ValueError("Body is shorter than its Content-Length")
+    return body
+
+
+class PendingFace(object):
+    """
+    A face waiting for its prediction, the caller blocks on `done` until the batcher fills in the result.
+    """
+
+    def __init__(self, face):
+        """
+
+        Args:
+            face: sanitized face of size IMG_SIZE
+        """
+        self.face = face
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.start_time = time.time()
+
+
+class MicroBatcher(object):
+    """
+    Serves predictions of a NeuralNet to concurrent callers. A single thread takes the first waiting face, then
+    keeps gathering faces until it has `max_batch_size` of them or `max_wait` seconds passed since the first one,
+    and classifies the batch with one predict_batch call.
+
+    parameters
+    ----------
+    neural_net : nets.base.NeuralNet
+    max_batch_size : int
+    max_wait : float
+        seconds the first face of a batch may wait for more faces
+    """
+
+    def __init__(self, neural_net, max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait=SERVER_MAX_WAIT_MS / 1000.0):
+        """
+
+        Args:
+            neural_net:
+            max_batch_size:
+            max_wait:
+        """
+        assert max_batch_size > 0, "Batches must hold at least one face"
+        self.neural_net = neural_net
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.batch_sizes = np.zeros(max_batch_size + 1, dtype=np.int64)
+        self.queue_depths = {}
+        self.max_queue_depth = 0
+        self.latencies = LatencyHistogram()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def predict(self, face, timeout=None):
+        """
+        Blocks until the batch holding face has been classified.
+
+        Args:
+            face: sanitized face of size IMG_SIZE
+            timeout: seconds, waits until the batcher stops if None
+
+        Returns:
+            class probabilities of face
+        """
+        if not self.running:
+            raise BatcherStopped("The batcher is stopped")
+        pending_face = PendingFace(face)
+        self.pending.put(pending_face)
+        # checks every second that the batching thread is still there to classify the face
+        while not pending_face.done.wait(1.0 if timeout is None else min(1.0, timeout)):
+            if not self.thread.is_alive():
+                raise BatcherStopped("The batcher stopped before classifying the face")
+            if timeout is not None and time.time() - pending_face.start_time >= timeout:
+                raise Exception("Prediction timed out after " + str(timeout) + "s")
+        if pending_face.error is not None:
+            raise pending_face.error
+        return pending_face.result
+
+    def gather(self):
+        """
+
+        Returns:
+            list of up to max_batch_size PendingFace, empty once the batcher is stopped
+        """
+        while self.running:
+            try:
+                batch = [self.pending.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                continue
+        else:
+            return []
+        deadline = batch[0].start_time + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self.pending.get(timeout=remaining) if remaining > 0 else self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        """
+        Classifies the gathered batches until the batcher is stopped.
+        """
+        while self.running:
+            batch = self.gather()
+            if len(batch) == 0:
+                continue
+            queue_depth = self.pending.qsize()
+            try:
+                predictions = self.neural_net.predict_batch([pending_face.face for pending_face in batch])
+                for pending_face, prediction in zip(batch, predictions):
+                    pending_face.result = prediction
+            except Exception as e:
+                for pending_face in batch:
+                    pending_face.error = e
+            end_time = time.time()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+                self.queue_depths[queue_depth] = self.queue_depths.get(queue_depth, 0) + 1
+                for pending_face in batch:
+                    self.latencies.record(end_time - pending_face.start_time)
+            for pending_face in batch:
+                pending_face.done.set()
+
+    def metrics(self):
+        """
+
+        Returns:
+            dict with the number of requests and batches, the batch size and queue depth distributions, the
+            current queue depth and the request latency percentiles in ms
+        """
+        with self.lock:
+            batches = int(self.batch_sizes.sum())
+            requests = int(np.dot(self.batch_sizes, np.arange(len(self.batch_sizes))))
+            latencies = {}
+            if self.latencies.count > 0:
+                latencies = {"p50_ms": self.latencies.percentile(50) * 1000,
+                             "p95_ms": self.latencies.percentile(95) * 1000,
+                             "p99_ms": self.latencies.percentile(99) * 1000}
+            return {"requests": requests, "batches": batches,
+                    "mean_batch_size": requests / float(batches) if batches > 0 else 0,
+                    "batch_sizes": {str(size): int(count) for size, count in enumerate(self.batch_sizes) if count},
+                    "queue_depth": self.pending.qsize(),
+                    "max_queue_depth": self.max_queue_depth,
+                    "queue_depths": {str(depth): count for depth, count in sorted(self.queue_depths.items())},
+                    "latency": latencies}
+
+    def stop(self):
+        """
+        Stops the batching thread, the callers of faces still waiting get a BatcherStopped error.
+        """
+        self.running = False
+        self.thread.join(1.0)
+        while True:
+            try:
+                pending_face = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            pending_face.error = BatcherStopped("The batcher stopped before classifying the face")
+            pending_face.done.set()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the server, `server.batcher` classifies the faces and `server.preprocessor` sanitizes them.
+    """
+
+    def address_string(self):
+        """
+
+        Returns:
+            client address, unix socket clients have none
+        """
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return str(self.client_address[0])
+        return "unix"
+
+    def send_json(self, status, content):
+        """
+
+        Args:
+            status: http status code
+            content: json serializable answer
+        """
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """
+        Answers the metrics of the batcher.
+        """
+        if self.path != "/metrics":
+            self.send_json(404, {"error": "Unknown path " + self.path})
+            return
+        self.send_json(200, self.server.batcher.metrics())
+
+    def do_POST(self):
+        """
+        Classifies the face image of the body.
+        """
+        import cv2
+        if self.path != "/predict":
+            self.send_json(404, {"error": "Unknown path " + self.path})
+            return
+        try:
+            body = read_body(self)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        # the nets take gray faces, decoding to 8 bit gray also accepts rgba and 16 bit images
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            self.send_json(400, {"error": "Body is not an encoded image"})
+            return
+        try:
+            probabilities = self.server.batcher.predict(self.server.preprocessor.sanitize(image))
+        except BatcherStopped as e:
+            self.send_json(503, {"error": str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        classifier = self.server.preprocessor.classifier
+        self.send_json(200, {"emotion": classifier.get_string(int(np.argmax(probabilities))),
+                             "probabilities": np.asarray(probabilities).tolist()})
+
+    def log_message(self, format, *args):
+        """
+        Requests are counted in the metrics instead of being logged one by one.
+        """
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each connection in its own thread, so concurrent requests reach the batcher together.
+    """
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """
+    The same server on a unix socket.
+    """
+    daemon_threads = True
+
+    def server_bind(self):
+        """
+        Binds the socket, replacing the socket file of a previous server.
+        """
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def build_neural_net(network_type=NETWORK_TYPE, model_path=MODEL_PATH):
+    """
+
+    Args:
+        network_type: si, mi or dinn
+        model_path: path of the model without the .json and .h5 extensions
+
+    Returns:
+        net loading model_path, with the tflite backend if INFERENCE_BACKEND is tflite
+    """
+    from preprocess.base import Preprocessor
+    input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
+    preprocessor = Preprocessor(SevenEmotionsClassifier(), input_shape=input_shape)
+    if network_type == "mi":
+        from nets.multinput import MultiInputNeuralNet
+        neural_net = MultiInputNeuralNet(input_shape, learning_rate=1e-4, batch_size=1, epochs=1, steps_per_epoch=1,
+                                         dataset_dir=None, preprocessor=preprocessor, train=False)
+    elif network_type == "dinn":
+        from nets.dlib_inputs import DlibPointsInputNeuralNet
+        neural_net = DlibPointsInputNeuralNet(input_shape, preprocessor=preprocessor, train=False)
+    elif network_type == "si":
+        from nets.base import NeuralNet
+        neural_net = NeuralNet(input_shape, learning_rate=1e-4, batch_size=1, epochs=1, steps_per_epoch=1,
+                               data_set_dir=None, preprocessor=preprocessor, train=False)
+    else:
+        raise Exception("The inference server serves the single face nets: si, mi and dinn")
+    if INFERENCE_BACKEND == "tflite":
+        neural_net.use_tflite(model_path)
+    else:
+        neural_net.model = neural_net.load_model(model_path)
+    return neural_net
+
+
+def serve(neural_net, host=SERVER_HOST, port=SERVER_PORT, unix_socket=SERVER_UNIX_SOCKET,
+          max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait=SERVER_MAX_WAIT_MS / 1000.0):
+    """
+    Serves neural_net until interrupted.
+
+    Args:
+        neural_net:
+        host:
+        port:
+        unix_socket: path of a unix socket listened on instead of host and port if not None
+        max_batch_size:
+        max_wait: seconds
+    """
+    if unix_socket is not None:
+        assert hasattr(socket, "AF_UNIX"), "Unix sockets are not supported on this platform"
+        server = ThreadingUnixHTTPServer(unix_socket, InferenceRequestHandler)
+        print("Serving on unix socket", unix_socket)
+    else:
+        server = ThreadingHTTPServer((host, port), InferenceRequestHandler)
+        print("Serving on http://" + host + ":" + str(port))
+    server.batcher = MicroBatcher(neural_net, max_batch_size, max_wait)
+    server.preprocessor = neural_net.preprocessor
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+
+def main():
+    """
+    Starts the server.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--network_type", default=NETWORK_TYPE, type=str, choices=["si", "mi", "dinn"])
+    parser.add_argument("--model", default=MODEL_PATH, type=str, help="model path without the .json and .h5 extensions")
+    parser.add_argument("--host", default=SERVER_HOST, type=str)
+    parser.add_argument("--port", default=SERVER_PORT, type=int)
+    parser.add_argument("--unix_socket", default=SERVER_UNIX_SOCKET, type=str)
+    parser.add_argument("--max_batch_size", default=SERVER_MAX_BATCH_SIZE, type=int)
+    parser.add_argument("--max_wait_ms", default=SERVER_MAX_WAIT_MS, type=float)
+    args = parser.parse_args()
+    serve(build_neural_net(args.network_type, args.model), args.host, args.port, args.unix_socket,
+          args.max_batch_size, args.max_wait_ms / 1000.0)
+
+
+if __name__ == "__main__":
+    main()
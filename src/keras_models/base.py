@@ -1,12 +1,16 @@
 import os
 
+import dlib
 import keras
 import numpy as np
 from keras.layers import Flatten, Dense, Conv2D, MaxPooling2D
-from keras.models import Sequential, model_from_json
+from keras.models import Sequential
 
-from config import MODEL_PATH, LOG_DIR, PATH2SAVE_MODELS, DATA_SET_DIR
+from config import IMG_SIZE, MODEL_PATH, LOG_DIR, PATH2SAVE_MODELS, DATA_SET_DIR, SHAPE_PREDICTOR_PATH
+from preprocess.feature_extraction import DlibFeatureExtractor
+from preprocess.prefetch import prefetch_flow
 from util.BaseLogger import EmopyLogger
+from util.model_registry import lazy_model
 
 
 # TODO Add PReLU, pooling, BN, look at capsule/merge
@@ -43,6 +47,7 @@ class NeuralNet(object):
         self.models_local_folder = "nn"
         self.logs_local_folder = self.models_local_folder
         self.preprocessor = preprocessor
+        self._dlib_feature_extractor = None
 
         self.epochs = epochs
         self.batch_size = batch_size
@@ -102,17 +107,26 @@ class NeuralNet(object):
 
     def load_model(self, model_path):
         """
+        The model is read on first use and shared with every net loading the same files.
 
         Args:
-            model_path:
+            model_path: path of the model without the .json and .h5 extensions
 
         Returns:
+            util.model_registry.LazyModel
+        """
+        return lazy_model(model_path)
+
+    def use_tflite(self, model_path=MODEL_PATH):
+        """
+        Replaces the keras model by its tflite conversion for inference, converting it if needed. Training and
+        the keras specific helpers need the keras model afterwards.
 
+        Args:
+            model_path: path of the model without the .json and .h5 extensions
         """
-        with open(model_path + ".json") as model_file:
-            model = model_from_json(model_file.read())
-            model.load_weights(model_path + ".h5")
-            return model
+        from nets.tflite_backend import load_tflite_model
+        self.model = load_tflite_model(model_path)
 
     def save_model(self):
         """
@@ -152,13 +166,56 @@ class NeuralNet(object):
         # self.model.fit(x_train,y_train,epochs = EPOCHS,
         #                 batch_size = BATCH_SIZE,validation_data=(x_test,y_test))
         self.preprocessor = self.preprocessor(DATA_SET_DIR)
-        self.model.fit_generator(self.preprocessor.flow(), steps_per_epoch=self.steps_per_epoch,
+        self.model.fit_generator(prefetch_flow(self.preprocessor), steps_per_epoch=self.steps_per_epoch,
                                  epochs=self.epochs,
                                  validation_data=(self.preprocessor.test_images, self.preprocessor.test_image_emotions))
         score = self.model.evaluate(self.preprocessor.test_images, self.preprocessor.test_image_emotions)
         self.save_model()
         self.logger.log_model(self.models_local_folder, score)
 
+    def stack_faces(self, faces):
+        """
+        Stacks sanitized faces into one batch.
+
+        Args:
+            faces: list or array of sanitized faces of size IMG_SIZE
+
+        Returns:
+            uint8 array of shape (N, IMG_SIZE[0], IMG_SIZE[1], 1)
+        """
+        faces = np.asarray(faces, dtype=np.uint8)
+        if faces.size == 0:
+            return np.zeros((0, IMG_SIZE[0], IMG_SIZE[1], 1), dtype=np.uint8)
+        assert faces.shape[1:3] == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
+        return faces.reshape(-1, IMG_SIZE[0], IMG_SIZE[1], 1)
+
+    def get_dlib_feature_extractor(self):
+        """
+
+        Returns:
+            dlib feature extractor of the net used by predict_batch, built on first use. It is not the one of the
+            preprocessor, which the training flow and its prefetch workers use.
+        """
+        if self._dlib_feature_extractor is None:
+            self._dlib_feature_extractor = DlibFeatureExtractor(dlib.shape_predictor(SHAPE_PREDICTOR_PATH))
+        return self._dlib_feature_extractor
+
+    def predict_batch(self, faces):
+        """
+        Predicts the emotions of any number of faces with a single forward pass.
+
+        Args:
+            faces: list or array of sanitized faces of size IMG_SIZE
+
+        Returns:
+            array of shape (N, number_of_class)
+        """
+        faces = self.stack_faces(faces)
+        if len(faces) == 0:
+            return np.zeros((0, self.number_of_class))
+        faces = faces.astype(np.float32) / 255
+        return self.model.predict(faces, batch_size=len(faces))
+
     def predict(self, face):
         """
 
@@ -169,7 +226,4 @@ class NeuralNet(object):
 
         """
         assert face.shape == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
-        face = face.reshape(-1, 64, 64, 1)
-        face = face.astype(np.float32) / 255
-        emotions = self.model.predict(face)
-        return emotions
+        return self.predict_batch([face])
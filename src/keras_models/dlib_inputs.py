@@ -1,11 +1,13 @@
 import os
 
 import keras
+import numpy as np
 from keras.layers import Input, Flatten, Dense, Conv2D, Dropout
 from keras.models import Model
 from nets.base import NeuralNet
 
 from config import IMG_SIZE, MODEL_PATH, LEARNING_RATE, EPOCHS, BATCH_SIZE, DATA_SET_DIR, LOG_DIR, STEPS_PER_EPOCH
+from preprocess.prefetch import prefetch_flow
 from util.BaseLogger import EmopyLogger
 
 
@@ -33,6 +35,7 @@ class DlibPointsInputNeuralNet(NeuralNet):
         self.models_local_folder = "dinn"
         self.logs_local_folder = self.models_local_folder
         self.preprocessor = preprocessor
+        self._dlib_feature_extractor = None
         self.epochs = EPOCHS
         self.batch_size = BATCH_SIZE
         self.steps_per_epoch = STEPS_PER_EPOCH
@@ -117,7 +120,7 @@ class DlibPointsInputNeuralNet(NeuralNet):
         #                 batch_size = BATCH_SIZE,validation_data=(x_test,y_test))
         self.preprocessor = self.preprocessor(DATA_SET_DIR)
         self.model.summary()
-        self.model.fit_generator(self.preprocessor.flow(), steps_per_epoch=self.steps_per_epoch,
+        self.model.fit_generator(prefetch_flow(self.preprocessor), steps_per_epoch=self.steps_per_epoch,
                                  epochs=self.epochs,
                                  validation_data=([self.preprocessor.test_dpoints, self.preprocessor.dpointsDists,
                                                    self.preprocessor.dpointsAngles],
@@ -128,6 +131,23 @@ class DlibPointsInputNeuralNet(NeuralNet):
         self.save_model()
         self.logger.log_model(self.models_local_folder, score)
 
+    def predict_batch(self, faces):
+        """
+        Predicts the emotions of any number of faces from their dlib points, distances and angles with a single
+        forward pass.
+
+        Args:
+            faces: list or array of sanitized faces of size IMG_SIZE
+
+        Returns:
+            array of shape (N, number_of_class)
+        """
+        faces = self.stack_faces(faces)
+        if len(faces) == 0:
+            return np.zeros((0, self.number_of_class))
+        _, dpoints, dpoints_dists, dpoints_angles = self.get_dlib_feature_extractor().extract(faces)
+        return self.model.predict([dpoints, dpoints_dists, dpoints_angles], batch_size=len(faces))
+
     def predict(self, face):
         """
 
@@ -138,6 +158,5 @@ class DlibPointsInputNeuralNet(NeuralNet):
 
         """
         assert face.shape == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
-        face = face.reshape(-1, 48, 48, 1)
-        emotions = self.model.predict(face)[0]
+        emotions = self.predict_batch([face])[0]
         return emotions
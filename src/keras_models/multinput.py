@@ -1,13 +1,14 @@
 import os
 
-import cv2
 import keras
+import numpy as np
 from keras.layers import Input, Flatten, Dense, Conv2D, MaxPooling2D, Dropout
 from keras.models import Model
 from nets.base import NeuralNet
 from pandas import json
 
 from config import IMG_SIZE, MODEL_PATH, LOG_DIR
+from preprocess.prefetch import prefetch_flow
 from util.BaseLogger import EmopyLogger
 
 
@@ -133,6 +134,7 @@ class MultiInputNeuralNet(NeuralNet):
         self.models_local_folder = "minn"
         self.logs_local_folder = self.models_local_folder
         self.preprocessor = preprocessor
+        self._dlib_feature_extractor = None
         self.epochs = epochs
         self.batch_size = batch_size
         self.learning_rate = learning_rate
@@ -238,7 +240,7 @@ class MultiInputNeuralNet(NeuralNet):
         self.preprocessor = self.preprocessor(self.dataset_dir)
         print("lr", self.learning_rate)
         print("batch_size", self.batch_size)
-        self.model.fit_generator(self.preprocessor.flow(), steps_per_epoch=self.steps_per_epoch,
+        self.model.fit_generator(prefetch_flow(self.preprocessor), steps_per_epoch=self.steps_per_epoch,
                                  epochs=self.epochs,
                                  validation_data=([self.preprocessor.test_images, self.preprocessor.test_dpoints,
                                                    self.preprocessor.dpointsDists, self.preprocessor.dpointsAngles],
@@ -249,6 +251,23 @@ class MultiInputNeuralNet(NeuralNet):
         self.save_model()
         self.logger.log_model(self.models_local_folder, score)
 
+    def predict_batch(self, faces):
+        """
+        Predicts the emotions of any number of faces, extracting their dlib features in one call and running a
+        single forward pass.
+
+        Args:
+            faces: list or array of sanitized faces of size IMG_SIZE
+
+        Returns:
+            array of shape (N, number_of_class)
+        """
+        faces = self.stack_faces(faces)
+        if len(faces) == 0:
+            return np.zeros((0, self.number_of_class))
+        images, dpoints, dpoints_dists, dpoints_angles = self.get_dlib_feature_extractor().extract(faces)
+        return self.model.predict([images, dpoints, dpoints_dists, dpoints_angles], batch_size=len(faces))
+
     def predict(self, face):
         """
 
@@ -259,10 +278,5 @@ class MultiInputNeuralNet(NeuralNet):
 
         """
         assert face.shape == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
-        face = face.reshape(1, 64, 64)
-
-        cv2.imshow("img", face)
-        cv2.waitKey(0)
-        cv2.destroyAllWindows()
-        emotions = self.model.predict(face)[0]
+        emotions = self.predict_batch([face])[0]
         return emotions
@@ -0,0 +1,209 @@
+"""
+Post-training int8 quantization of the saved nets, calibrated on the train set and evaluated on the test set of a
+preprocessor.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from config import IMG_SIZE, DATA_SET_DIR, NETWORK_TYPE, MODEL_PATH
+from nets.tflite_backend import convert, TFLiteModel, measure_latency, get_tflite_path
+from preprocess.base import Preprocessor
+from preprocess.dlib_input import DlibInputPreprocessor
+from preprocess.multinput import MultiInputPreprocessor
+from util import SevenEmotionsClassifier
+from util.model_registry import lazy_model
+
+
+def get_test_inputs(preprocessor):
+    """
+
+    Args:
+        preprocessor: called preprocessor
+
+    Returns:
+        list of the test inputs of the net trained with preprocessor, in the order of its inputs
+    """
+    if isinstance(preprocessor, MultiInputPreprocessor):
+        return [preprocessor.test_images, preprocessor.test_dpoints, preprocessor.dpointsDists,
+                preprocessor.dpointsAngles]
+    if isinstance(preprocessor, DlibInputPreprocessor):
+        return [preprocessor.test_dpoints, preprocessor.dpointsDists, preprocessor.dpointsAngles]
+    return [preprocessor.test_images]
+
+
+def get_preprocessor(network_type, input_shape):
+    """
+
+    Args:
+        network_type: si, mi or dinn
+        input_shape:
+
+    Returns:
+        preprocessor producing the inputs of the net of network_type
+    """
+    classifier = SevenEmotionsClassifier()
+    if network_type == "mi":
+        return MultiInputPreprocessor(classifier, input_shape=input_shape)
+    if network_type == "dinn":
+        return DlibInputPreprocessor(classifier, input_shape=input_shape)
+    if network_type == "si":
+        return Preprocessor(classifier, input_shape=input_shape)
+    raise Exception("Quantization supports the image nets: si, mi and dinn")
+
+
+def sample_calibration_inputs(preprocessor, number_of_samples, random_state):
+    """
+    Draws the calibration samples from the train split, so the accuracy reported on the test split is not measured
+    on the samples the quantization ranges were fitted to.
+
+    Args:
+        preprocessor: called preprocessor
+        number_of_samples:
+        random_state: numpy RandomState shuffling the train set
+
+    Returns:
+        list of input arrays of the sampled train rows, in the order of the inputs of the net
+    """
+    assert len(preprocessor.train_image_emotions) > preprocessor.batch_size, \
+        "Calibration needs more train images than the batch size of the preprocessor"
+    preprocessor.random_state = random_state
+    flow = preprocessor.flow()
+    batches = []
+    while sum(len(batch[0]) for batch in batches) < number_of_samples:
+        batch_inputs, _ = next(flow)
+        batches.append(batch_inputs if isinstance(batch_inputs, list) else [batch_inputs])
+    return [np.asarray(np.concatenate([batch[i] for batch in batches])[:number_of_samples], dtype=np.float32)
+            for i in range(len(batches[0]))]
+
+
+def int8_configuration(calibration_inputs):
+    """
+
+    Args:
+        calibration_inputs: list of input arrays, one row per calibration sample
+
+    Returns:
+        function setting full integer quantization on a tflite converter
+    """
+
+    def configure(converter):
+        """
+
+        Args:
+            converter: tf.lite.TFLiteConverter
+        """
+        import tensorflow as tf
+
+        def representative_dataset():
+            """
+            Yields one calibration sample at a time.
+            """
+            for i in range(len(calibration_inputs[0])):
+                yield [values[i:i + 1] for values in calibration_inputs]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    return configure
+
+
+def quantize(model_path, calibration_inputs, output_path=None):
+    """
+    Converts the saved model to a tflite model whose weights and activations are int8. Activation ranges are
+    calibrated on calibration_inputs.
+
+    Args:
+        model_path: path of the model without the .json and .h5 extensions
+        calibration_inputs: list of input arrays
+        output_path: model_path + "-int8.tflite" by default
+
+    Returns:
+        path of the quantized model
+    """
+    if output_path is None:
+        output_path = model_path + "-int8.tflite"
+    return convert(model_path, output_path, configure=int8_configuration(calibration_inputs))
+
+
+def accuracy(model, inputs, labels, batch_size=256):
+    """
+
+    Args:
+        model: keras model or TFLiteModel
+        inputs: list of input arrays
+        labels: one hot labels
+        batch_size: number of samples per prediction
+
+    Returns:
+        fraction of the samples whose most likely emotion is the label
+    """
+    correct = 0
+    for start in range(0, len(labels), batch_size):
+        batch = [values[start:start + batch_size] for values in inputs]
+        if not isinstance(model, TFLiteModel) and len(batch) == 1:
+            batch = batch[0]
+        predictions = model.predict(batch)
+        correct += int(np.sum(np.argmax(predictions, axis=1) == np.argmax(labels[start:start + batch_size], axis=1)))
+    return correct / float(len(labels))
+
+
+def compare(models, inputs, labels):
+    """
+
+    Args:
+        models: list of (name, model, size in bytes)
+        inputs: list of test input arrays
+        labels: one hot test labels
+
+    Returns:
+        list of dicts with the name, size, batch size 1 latency and test accuracy of every model
+    """
+    single = [values[:1] for values in inputs]
+    return [{"name": name, "bytes": size, "latency_ms": measure_latency(model, single) * 1000,
+             "accuracy": accuracy(model, inputs, labels)} for name, model, size in models]
+
+
+def main():
+    """
+    Quantizes a saved net and reports its size, latency and accuracy next to the float keras and tflite models.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=MODEL_PATH, type=str, help="model path without the .json and .h5 extensions")
+    parser.add_argument("--network_type", default=NETWORK_TYPE, type=str, help="si, mi or dinn")
+    parser.add_argument("--data_set_dir", default=DATA_SET_DIR, type=str, help="packed or directory data set")
+    parser.add_argument("--calibration_samples", default=200, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--out", default=None, type=str, help="json file receiving the report")
+    args = parser.parse_args()
+
+    preprocessor = get_preprocessor(args.network_type, (IMG_SIZE[0], IMG_SIZE[1], 1))
+    preprocessor(args.data_set_dir)
+    inputs = get_test_inputs(preprocessor)
+    labels = preprocessor.test_image_emotions
+    calibration_inputs = sample_calibration_inputs(preprocessor, args.calibration_samples,
+                                                   np.random.RandomState(args.seed))
+
+    float_path = convert(args.model)
+    int8_path = quantize(args.model, calibration_inputs)
+    report = compare([("keras float32", lazy_model(args.model).get(), os.path.getsize(args.model + ".h5")),
+                      ("tflite float32", TFLiteModel(float_path), os.path.getsize(get_tflite_path(args.model))),
+                      ("tflite int8", TFLiteModel(int8_path), os.path.getsize(int8_path))], inputs, labels)
+    for row in report:
+        print("{:<16} {:>10} bytes {:>9.3f} ms {:>8.4f} accuracy".format(row["name"], row["bytes"],
+                                                                       row["latency_ms"], row["accuracy"]))
+    if args.out is not None:
+        with open(args.out, "w") as report_file:
+            json.dump({"model": args.model, "calibration_samples": len(calibration_inputs[0]),
+                       "test_samples": len(labels), "models": report}, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
+import copy
 import os
+from collections import OrderedDict
 
 import cv2
 import keras
 import numpy as np
-from keras.layers import LSTM, Dense, Conv2D, TimeDistributed
+from keras import backend as K
+from keras.layers import LSTM, Dense, Conv2D, TimeDistributed, Input, InputLayer
 from keras.layers import MaxPooling2D, Flatten
-from keras.models import model_from_json, Sequential
+from keras.models import model_from_json, Sequential, Model
 from nets.base import NeuralNet
 
-from config import LEARNING_RATE, EPOCHS, STEPS_PER_EPOCH, LOG_DIR
+from config import IMG_SIZE, LEARNING_RATE, EPOCHS, STEPS_PER_EPOCH, LOG_DIR
+from preprocess.prefetch import prefetch_flow
 from util.BaseLogger import EmopyLogger
+from util.model_registry import lazy_model
 
 
 class LSTMNet(NeuralNet):
@@ -31,6 +36,7 @@ class LSTMNet(NeuralNet):
         self.convnet_model_path = convnet_model_path
         self.max_sequence_length = 10
         self.postProcessor = postProcessor
+        self.sequence_predictor = None
         NeuralNet.__init__(self, input_shape, preprocessor, logger, train)
         self.models_local_folder = "rnn"
         self.logs_local_folder = self.models_local_folder
@@ -78,24 +84,75 @@ class LSTMNet(NeuralNet):
         """
         if path is None:
             self.convnet_model_path = "models/nn/nn-5"
-        with open(self.convnet_model_path + ".json") as model_file:
-            model = model_from_json(model_file.read())
-            model.load_weights(self.convnet_model_path + ".h5")
-            return model
+        return lazy_model(self.convnet_model_path)
 
     def predict(self, sequence_faces):
         """
 
         Args:
-            sequence_faces:
+            sequence_faces: the last max_sequence_length faces of size IMG_SIZE, oldest first
 
         Returns:
+            emotions of the sequence
+        """
+        return self.predict_sequence(sequence_faces[-self.max_sequence_length:])[0]
 
+    def predict_sequence(self, sequence_faces, stride=1):
         """
-        assert sequence_faces[0].shape == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
-        face = face.reshape(-1, self.max_sequence_length, 48, 48, 1)
-        emotions = self.model.predict(face)[0]
-        return emotions
+        Predicts every window of max_sequence_length consecutive faces of an offline sequence, encoding each face
+        once with the cached predictor of the net whatever the number of windows containing it.
+
+        Args:
+            sequence_faces: faces of size IMG_SIZE, oldest first
+            stride: number of faces between the starts of two windows
+
+        Returns:
+            array of shape (number of windows, number of classes)
+        """
+        assert sequence_faces[0].shape[:2] == IMG_SIZE, "Face image size should be " + str(IMG_SIZE)
+        frames = np.asarray(sequence_faces, dtype=np.float32).reshape((-1,) + tuple(self.model.input_shape[2:]))
+        if self.sequence_predictor is None:
+            self.sequence_predictor = self.cached_predictor()
+        return self.sequence_predictor.predict_rolling(frames, self.max_sequence_length, stride)
+
+    def split_model(self):
+        """
+        Splits self.model into a per-frame encoder, made of the layers wrapped by its leading TimeDistributed
+        layers, and a sequence head made of the remaining layers. Both reuse the layers of self.model and
+        therefore share its weights.
+
+        Returns:
+            encoder mapping frames to embeddings and head mapping sequences of embeddings to emotions
+        """
+        layers = [layer for layer in self.model.layers if not isinstance(layer, InputLayer)]
+        number_of_frame_layers = 0
+        while number_of_frame_layers < len(layers) and isinstance(layers[number_of_frame_layers], TimeDistributed):
+            number_of_frame_layers += 1
+        assert number_of_frame_layers > 0, "Model does not start with TimeDistributed layers"
+
+        frame_input = Input(shape=self.model.input_shape[2:])
+        embedding = frame_input
+        for layer in layers[:number_of_frame_layers]:
+            embedding = layer.layer(embedding)
+        encoder = Model(inputs=frame_input, outputs=embedding)
+
+        embeddings_input = Input(shape=(None,) + K.int_shape(embedding)[1:])
+        output = embeddings_input
+        for layer in layers[number_of_frame_layers:]:
+            output = layer(output)
+        head = Model(inputs=embeddings_input, outputs=output)
+        return encoder, head
+
+    def cached_predictor(self, max_cached_frames=1024):
+        """
+
+        Args:
+            max_cached_frames:
+
+        Returns:
+            CachedSequencePredictor encoding every frame once with this net
+        """
+        return CachedSequencePredictor(self, max_cached_frames)
 
     def process_web_cam(self):
         """
@@ -146,7 +203,7 @@ class LSTMNet(NeuralNet):
         # x_train,x_test,y_train ,y_test = train_test_split(self.X,self.y,test_size=0.3)
         # self.model.fit(x_train,y_train,epochs = EPOCHS, 
         #                 batch_size = BATCH_SIZE,validation_data=(x_test,y_test))
-        self.model.fit_generator(self.preprocessor.flow(), steps_per_epoch=STEPS_PER_EPOCH,
+        self.model.fit_generator(prefetch_flow(self.preprocessor), steps_per_epoch=STEPS_PER_EPOCH,
                                  epochs=EPOCHS,
                                  validation_data=(
                                      self.preprocessor.test_sequences_dpoints, self.preprocessor.test_sequence_labels))
@@ -181,7 +238,6 @@ class DlibLSTMNet(LSTMNet):
             print("Logging to file", os.path.join(LOG_DIR, self.logs_local_folder, self.logs_local_folder + ".txt"))
         else:
             self.logger = logger
-        self.model = self.build()
         self.model = self.load_model("models/drnn/drnn-2")
 
     def build(self):
@@ -218,6 +274,37 @@ class DlibLSTMNet(LSTMNet):
         emotions = self.model.predict(dlib_features)
         return emotions
 
+    def build_streaming_model(self, batch_size):
+        """
+        Stateful copy of the trained model taking one frame per step, with one batch row per face.
+
+        Args:
+            batch_size: maximum number of faces streamed at the same time
+
+        Returns:
+            keras.models.Sequential sharing the weights of self.model
+        """
+        config = copy.deepcopy(self.model.get_config())
+        layers = config["layers"] if isinstance(config, dict) else config
+        layers[0]["config"]["batch_input_shape"] = (batch_size, 1) + tuple(self.model.input_shape[2:])
+        for layer in layers:
+            if layer["class_name"] == "LSTM":
+                layer["config"]["stateful"] = True
+        model = Sequential.from_config(config)
+        model.set_weights(self.model.get_weights())
+        return model
+
+    def stream(self, max_faces=8):
+        """
+
+        Args:
+            max_faces:
+
+        Returns:
+            DlibLSTMStream predicting frame by frame with this net
+        """
+        return DlibLSTMStream(self, max_faces)
+
     def load_model(self, path):
         """
 
@@ -227,7 +314,184 @@ class DlibLSTMNet(LSTMNet):
         Returns:
 
         """
-        with open(path + ".json") as json_file:
-            model = model_from_json(json_file.read())
-            model.load_weights(path + ".h5")
-            return model
+        return lazy_model(path)
+
+
+class DlibLSTMStream(object):
+    """
+    Frame by frame inference with the stateful copy of a DlibLSTMNet. Each face owns one row of the batch and
+    the LSTM states of that row carry its whole history since it was first seen, so a prediction costs one step
+    whatever the length of the sequence.
+
+    parameters
+    ----------
+    neural_net : DlibLSTMNet
+    max_faces : int
+        number of faces that can be streamed at the same time, further faces are not predicted
+    """
+
+    def __init__(self, neural_net, max_faces=8):
+        """
+
+        Args:
+            neural_net:
+            max_faces:
+        """
+        self.model = neural_net.build_streaming_model(max_faces)
+        self.max_faces = max_faces
+        self.inputs = np.zeros(self.model.input_shape, dtype=np.float32)
+        self.lstm_layers = [layer for layer in self.model.layers if isinstance(layer, LSTM)]
+        self.slots = {}
+        self.free_slots = list(range(max_faces))
+
+    def clear_slot(self, slot):
+        """
+        Zeroes the LSTM states of one row of the batch.
+
+        Args:
+            slot:
+        """
+        for layer in self.lstm_layers:
+            for state in layer.states:
+                value = K.get_value(state)
+                value[slot] = 0
+                K.set_value(state, value)
+
+    def reset(self, face_id):
+        """
+        Forgets the history of a lost face and frees its row.
+
+        Args:
+            face_id:
+        """
+        slot = self.slots.pop(face_id, None)
+        if slot is not None:
+            self.clear_slot(slot)
+            self.free_slots.append(slot)
+
+    def retain(self, face_ids):
+        """
+        Resets every streamed face missing from face_ids.
+
+        Args:
+            face_ids:
+        """
+        for face_id in list(self.slots.keys()):
+            if face_id not in face_ids:
+                self.reset(face_id)
+
+    def step(self, face_frames):
+        """
+
+        Args:
+            face_frames: dict mapping face ids to their normalized dlib points of shape (68, 2, 1) in the new frame
+
+        Returns:
+            dict mapping the streamed face ids to their predictions
+        """
+        for face_id in face_frames:
+            if face_id not in self.slots and len(self.free_slots) > 0:
+                self.slots[face_id] = self.free_slots.pop(0)
+                self.clear_slot(self.slots[face_id])
+        streamed = [face_id for face_id in face_frames if face_id in self.slots]
+        if len(streamed) == 0:
+            return {}
+        # free rows step on zeros, their state is cleared again when they are given to a new face
+        self.inputs[...] = 0
+        for face_id in streamed:
+            self.inputs[self.slots[face_id], 0] = face_frames[face_id]
+        predictions = self.model.predict(self.inputs, batch_size=self.max_faces)
+        return {face_id: predictions[self.slots[face_id]] for face_id in streamed}
+
+
+class CachedSequencePredictor(object):
+    """
+    Predicts overlapping windows of frames with the encoder and head of an LSTMNet, keeping the embeddings of
+    the last `max_cached_frames` frames by frame id so a frame goes through the encoder only once, whatever
+    the number of windows containing it. Frame ids must identify the frames across calls of `predict`, use
+    `clear` before predicting frames of another sequence.
+
+    parameters
+    ----------
+    neural_net : LSTMNet
+    max_cached_frames : int
+    """
+
+    def __init__(self, neural_net, max_cached_frames=1024):
+        """
+
+        Args:
+            neural_net:
+            max_cached_frames:
+        """
+        self.encoder, self.head = neural_net.split_model()
+        self.max_cached_frames = max_cached_frames
+        self.embeddings = OrderedDict()
+        self.encoded_frames = 0
+
+    def clear(self):
+        """
+        Forgets the cached embeddings.
+        """
+        self.embeddings.clear()
+
+    def embed(self, frame_ids, frames):
+        """
+
+        Args:
+            frame_ids: ids of the frames to embed
+            frames: mapping or array giving the preprocessed frame of every id
+
+        Returns:
+            array of shape (len(frame_ids), embedding size)
+        """
+        missing = [frame_id for frame_id in OrderedDict.fromkeys(frame_ids) if frame_id not in self.embeddings]
+        if len(missing) > 0:
+            new_embeddings = self.encoder.predict(np.array([frames[frame_id] for frame_id in missing]))
+            self.encoded_frames += len(missing)
+            for frame_id, embedding in zip(missing, new_embeddings):
+                self.embeddings[frame_id] = embedding
+        output = np.array([self.embeddings[frame_id] for frame_id in frame_ids])
+        for frame_id in frame_ids:
+            self.embeddings[frame_id] = self.embeddings.pop(frame_id)
+        while len(self.embeddings) > self.max_cached_frames:
+            self.embeddings.popitem(last=False)
+        return output
+
+    def predict(self, windows, frames):
+        """
+
+        Args:
+            windows: list of windows, each a list of frame ids of the same length, oldest first
+            frames: mapping or array giving the preprocessed frame of every id
+
+        Returns:
+            array of shape (len(windows), number of classes)
+        """
+        window_length = len(windows[0])
+        flat_ids = [frame_id for window in windows for frame_id in window]
+        embeddings = self.embed(flat_ids, frames)
+        return self.head.predict(embeddings.reshape((len(windows), window_length) + embeddings.shape[1:]))
+
+    def predict_rolling(self, frames, window_length, stride=1, windows_per_batch=64):
+        """
+        Predicts every window of window_length consecutive frames, starting every stride frames. Frame ids are
+        indexes in frames, the embeddings of previous calls are therefore cleared first.
+
+        Args:
+            frames: array of preprocessed frames
+            window_length:
+            stride:
+            windows_per_batch: number of windows predicted with one call of the head
+
+        Returns:
+            array of shape (number of windows, number of classes)
+        """
+        self.clear()
+        windows = [list(range(start, start + window_length))
+                   for start in range(0, len(frames) - window_length + 1, stride)]
+        predictions = [self.predict(windows[i:i + windows_per_batch], frames)
+                       for i in range(0, len(windows), windows_per_batch)]
+        if len(predictions) == 0:
+            return np.zeros((0,) + self.head.output_shape[1:])
+        return np.concatenate(predictions)
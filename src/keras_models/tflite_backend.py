@@ -0,0 +1,338 @@
+"""
+TFLite export of the saved keras models and a TFLite interpreter usable in place of the keras model of a NeuralNet.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from config import TFLITE_THREADS
+from util.model_registry import lazy_model
+
+try:
+    import tensorflow as tf
+
+    Interpreter = tf.lite.Interpreter
+except ImportError:
+    tf = None
+    from tflite_runtime.interpreter import Interpreter
+
+
+def get_tflite_path(model_path):
+    """
+
+    Args:
+        model_path: path of the model without the .json and .h5 extensions
+
+    Returns:
+        path of its tflite flatbuffer
+    """
+    return model_path + ".tflite"
+
+
+def is_up_to_date(model_path):
+    """
+
+    Args:
+        model_path:
+
+    Returns:
+        True if the tflite flatbuffer of model_path exists and is newer than its json and h5 files
+    """
+    tflite_path = get_tflite_path(model_path)
+    if not os.path.exists(tflite_path) or not os.path.exists(tflite_path + ".json"):
+        return False
+    tflite_mtime = os.path.getmtime(tflite_path)
+    return all(os.path.getmtime(model_path + extension) <= tflite_mtime for extension in [".json", ".h5"])
+
+
+def get_converter(model):
+    """
+
+    Args:
+        model: keras model
+
+    Returns:
+        tf.lite.TFLiteConverter of model
+    """
+    assert tf is not None, "Converting a model to tflite requires tensorflow"
+    if hasattr(tf.lite.TFLiteConverter, "from_keras_model"):
+        return tf.lite.TFLiteConverter.from_keras_model(model)
+    from keras import backend as K
+    return tf.lite.TFLiteConverter.from_session(K.get_session(), model.inputs, model.outputs)
+
+
+def convert(model_path, output_path=None, configure=None):
+    """
+    Converts the saved keras model to a tflite flatbuffer. The keras input names are written next to it, in
+    output_path + ".json", so the interpreter takes its inputs in the same order as the keras model. Models
+    using ops without a tflite builtin, like the LSTMs of the rnn nets, fall back to tensorflow ops.
+
+    Args:
+        model_path: path of the model without the .json and .h5 extensions
+        output_path: path of the flatbuffer, model_path + ".tflite" by default
+        configure: function called with the converter before converting, used to set quantization options
+
+    Returns:
+        path of the flatbuffer
+    """
+    if output_path is None:
+        output_path = get_tflite_path(model_path)
+    model = lazy_model(model_path).get()
+    converter = get_converter(model)
+    if configure is not None:
+        configure(converter)
+    try:
+        flatbuffer = converter.convert()
+    except Exception:
+        converter = get_converter(model)
+        if configure is not None:
+            configure(converter)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        flatbuffer = converter.convert()
+    with open(output_path, "wb") as tflite_file:
+        tflite_file.write(flatbuffer)
+    with open(output_path + ".json", "w") as signature_file:
+        json.dump({"inputs": list(model.input_names),
+                   "input_shapes": [list(shape[1:]) for shape in get_input_shapes(model)]}, signature_file)
+    print("Converted", model_path, "to", output_path, "(" + str(len(flatbuffer)) + " bytes)")
+    return output_path
+
+
+def get_input_shapes(model):
+    """
+
+    Args:
+        model: keras model
+
+    Returns:
+        list of the input shapes of model, batch dimension included
+    """
+    input_shape = model.input_shape
+    return input_shape if isinstance(input_shape, list) else [input_shape]
+
+
+class TFLiteModel(object):
+    """
+    Runs a converted model with the tflite interpreter. predict takes the same inputs as the keras model, a
+    single array or the list of arrays of a multi-input model, so it replaces the keras model of a NeuralNet.
+    Quantized inputs and outputs are converted from and to floats with their quantization parameters.
+
+    The interpreter is resized when the batch size changes, consecutive predictions of the same batch size reuse
+    its tensors.
+
+    parameters
+    ----------
+    tflite_path : str
+    num_threads : int
+    """
+
+    def __init__(self, tflite_path, num_threads=TFLITE_THREADS):
+        """
+
+        Args:
+            tflite_path:
+            num_threads:
+        """
+        self.tflite_path = tflite_path
+        try:
+            self.interpreter = Interpreter(model_path=tflite_path, num_threads=num_threads)
+        except TypeError:
+            self.interpreter = Interpreter(model_path=tflite_path)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.get_ordered_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = None
+
+    def get_ordered_input_details(self):
+        """
+
+        Returns:
+            input details of the interpreter in the order of the inputs of the keras model
+        """
+        input_details = self.interpreter.get_input_details()
+        if not os.path.exists(self.tflite_path + ".json"):
+            return input_details
+        with open(self.tflite_path + ".json") as signature_file:
+            names = json.load(signature_file)["inputs"]
+        ordered = []
+        for name in names:
+            matches = [details for details in input_details if name in details["name"]]
+            assert len(matches) > 0, "Input " + name + " not found in " + self.tflite_path
+            ordered.append(sorted(matches, key=lambda details: len(details["name"]))[0])
+        return ordered
+
+    def resize(self, batch_size):
+        """
+
+        Args:
+            batch_size:
+        """
+        if batch_size == self.batch_size:
+            return
+        for details in self.input_details:
+            shape = [batch_size] + [int(size) for size in details["shape"][1:]]
+            self.interpreter.resize_tensor_input(details["index"], shape)
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def set_input(self, details, values):
+        """
+
+        Args:
+            details: interpreter input details
+            values: float input
+        """
+        scale, zero_point = details["quantization"]
+        if details["dtype"] in [np.int8, np.uint8] and scale > 0:
+            info = np.iinfo(details["dtype"])
+            values = np.clip(np.round(values / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(details["index"], np.asarray(values, dtype=details["dtype"]))
+
+    def get_output(self, details):
+        """
+
+        Args:
+            details: interpreter output details
+
+        Returns:
+            float output
+        """
+        values = self.interpreter.get_tensor(details["index"])
+        scale, zero_point = details["quantization"]
+        if details["dtype"] in [np.int8, np.uint8] and scale > 0:
+            return (values.astype(np.float32) - zero_point) * scale
+        return values.copy()
+
+    def predict(self, inputs, batch_size=None):
+        """
+
+        Args:
+            inputs: array, or list of arrays for multi-input models
+            batch_size: ignored, the whole input is one batch
+
+        Returns:
+            output array, or list of arrays for multi-output models
+        """
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        assert len(inputs) == len(self.input_details), "Model expects " + str(len(self.input_details)) + " inputs"
+        self.resize(len(inputs[0]))
+        for details, values in zip(self.input_details, inputs):
+            self.set_input(details, values)
+        self.interpreter.invoke()
+        outputs = [self.get_output(details) for details in self.output_details]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def size(self):
+        """
+
+        Returns:
+            size of the flatbuffer in bytes
+        """
+        return os.path.getsize(self.tflite_path)
+
+
+def load_tflite_model(model_path):
+    """
+    Converts the model if its flatbuffer is missing or older than its json and h5 files.
+
+    Args:
+        model_path: path of the model without the .json and .h5 extensions
+
+    Returns:
+        TFLiteModel
+    """
+    if not is_up_to_date(model_path):
+        convert(model_path)
+    return TFLiteModel(get_tflite_path(model_path))
+
+
+def random_inputs(input_shapes, batch_size, random_state=None):
+    """
+
+    Args:
+        input_shapes: shapes of the inputs without the batch dimension
+        batch_size:
+        random_state:
+
+    Returns:
+        list of uniform random float32 inputs in [0, 1)
+    """
+    if random_state is None:
+        random_state = np.random.RandomState(0)
+    return [random_state.rand(batch_size, *shape).astype(np.float32) for shape in input_shapes]
+
+
+def check_equivalence(keras_model, tflite_model, inputs, atol=1e-4):
+    """
+    Compares the predictions of the keras model and of its tflite conversion.
+
+    Args:
+        keras_model:
+        tflite_model: TFLiteModel
+        inputs: list of input arrays
+        atol: maximum absolute difference allowed
+
+    Returns:
+        maximum absolute difference between the predictions
+    """
+    expected = keras_model.predict(inputs if len(inputs) > 1 else inputs[0])
+    actual = tflite_model.predict(inputs)
+    if not isinstance(expected, list):
+        expected, actual = [expected], [actual]
+    difference = max(float(np.max(np.abs(np.asarray(e) - np.asarray(a)))) for e, a in zip(expected, actual))
+    if difference > atol:
+        raise Exception("TFLite predictions differ from keras by " + str(difference) + " (tolerance " + str(atol) + ")")
+    return difference
+
+
+def measure_latency(model, inputs, repeats=50):
+    """
+
+    Args:
+        model: keras model or TFLiteModel
+        inputs: list of input arrays
+        repeats:
+
+    Returns:
+        median latency of one prediction in seconds
+    """
+    model_inputs = inputs if isinstance(model, TFLiteModel) or len(inputs) > 1 else inputs[0]
+    model.predict(model_inputs)
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.time()
+        model.predict(model_inputs)
+        latencies.append(time.time() - start_time)
+    return float(np.median(latencies))
+
+
+def main():
+    """
+    Converts a saved model and checks the tflite predictions against keras on random inputs.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, type=str, help="model path without the .json and .h5 extensions")
+    parser.add_argument("--out", default=None, type=str)
+    parser.add_argument("--check_samples", default=8, type=int, help="random samples compared with keras, 0 skips")
+    parser.add_argument("--atol", default=1e-4, type=float)
+    args = parser.parse_args()
+
+    tflite_path = convert(args.model, args.out)
+    if args.check_samples > 0:
+        keras_model = lazy_model(args.model).get()
+        tflite_model = TFLiteModel(tflite_path)
+        inputs = random_inputs([shape[1:] for shape in get_input_shapes(keras_model)], args.check_samples)
+        print("Max absolute difference:", check_equivalence(keras_model, tflite_model, inputs, args.atol))
+        single = [values[:1] for values in inputs]
+        print("Batch size 1 latency: keras", round(measure_latency(keras_model, single) * 1000, 3), "ms, tflite",
+              round(measure_latency(tflite_model, single) * 1000, 3), "ms")
+
+
+if __name__ == "__main__":
+    main()
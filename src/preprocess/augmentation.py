@@ -0,0 +1,119 @@
+"""
+Batched random affine augmentation of grayscale images.
+"""
+import numpy as np
+
+
+class BatchAugmenter(object):
+    """
+    Samples rotation, shift and zoom for a whole batch at once, builds all affine matrices in one vectorized
+    step and warps the batch with bilinear interpolation and nearest fill mode, the defaults of
+    keras.preprocessing.image.ImageDataGenerator.
+
+    parameters
+    ----------
+    rotation_range : float
+        degree range of the random rotations
+    width_shift_range : float
+        fraction of the width of the random horizontal shifts
+    height_shift_range : float
+        fraction of the height of the random vertical shifts
+    zoom_range : float
+        random zoom is sampled from [1 - zoom_range, 1 + zoom_range] for each axis
+    """
+
+    def __init__(self, rotation_range=20, width_shift_range=0.2, height_shift_range=0.2, zoom_range=0.2):
+        """
+
+        Args:
+            rotation_range:
+            width_shift_range:
+            height_shift_range:
+            zoom_range:
+        """
+        self.rotation_range = rotation_range
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.zoom_range = zoom_range
+
+    def sample_matrices(self, n, shape, random_state):
+        """
+        Affine matrices mapping output (row, col) coordinates to input coordinates.
+
+        Args:
+            n: number of matrices
+            shape: (height, width) of the images
+            random_state: numpy.random.RandomState
+
+        Returns:
+            array of shape (n, 2, 3)
+        """
+        height, width = shape
+        theta = np.deg2rad(random_state.uniform(-self.rotation_range, self.rotation_range, n))
+        shifts = np.stack([random_state.uniform(-self.height_shift_range, self.height_shift_range, n) * height,
+                           random_state.uniform(-self.width_shift_range, self.width_shift_range, n) * width], axis=1)
+        zooms = random_state.uniform(1 - self.zoom_range, 1 + self.zoom_range, (n, 2))
+
+        cos, sin = np.cos(theta), np.sin(theta)
+        rotations = np.stack([np.stack([cos, -sin], axis=1), np.stack([sin, cos], axis=1)], axis=1)
+        linear = rotations * zooms[:, np.newaxis, :]
+        # rotate, shift and zoom around the image center
+        center = np.array([height / 2.0 + 0.5, width / 2.0 + 0.5])
+        offsets = center - np.einsum("nij,j->ni", linear, center) + np.einsum("nij,nj->ni", rotations, shifts)
+        return np.concatenate([linear, offsets[:, :, np.newaxis]], axis=2)
+
+    def warp(self, images, matrices, out=None):
+        """
+
+        Args:
+            images: array of shape (N, height, width)
+            matrices: array of shape (N, 2, 3) as returned by sample_matrices
+            out: array of shape (N, height, width) written to, may be images itself, allocated if None
+
+        Returns:
+            warped images
+        """
+        n, height, width = images.shape
+        if out is None:
+            out = np.empty_like(images)
+        rows, cols = np.meshgrid(np.arange(height, dtype=np.float32), np.arange(width, dtype=np.float32),
+                                 indexing="ij")
+        src_rows = (matrices[:, 0, 0, None, None] * rows + matrices[:, 0, 1, None, None] * cols +
+                    matrices[:, 0, 2, None, None])
+        src_cols = (matrices[:, 1, 0, None, None] * rows + matrices[:, 1, 1, None, None] * cols +
+                    matrices[:, 1, 2, None, None])
+        np.clip(src_rows, 0, height - 1, out=src_rows)
+        np.clip(src_cols, 0, width - 1, out=src_cols)
+
+        row0 = np.floor(src_rows).astype(np.intp)
+        col0 = np.floor(src_cols).astype(np.intp)
+        row1 = np.minimum(row0 + 1, height - 1)
+        col1 = np.minimum(col0 + 1, width - 1)
+        row_weight = src_rows - row0
+        col_weight = src_cols - col0
+
+        # float copy of the batch, out may alias images
+        flat = images.reshape(n, -1).astype(np.float32)
+        batch = np.arange(n)[:, None, None]
+        top = (flat[batch, row0 * width + col0] * (1 - col_weight) + flat[batch, row0 * width + col1] * col_weight)
+        bottom = (flat[batch, row1 * width + col0] * (1 - col_weight) + flat[batch, row1 * width + col1] * col_weight)
+        warped = top * (1 - row_weight) + bottom * row_weight
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            np.clip(np.rint(warped), info.min, info.max, out=warped)
+        out[...] = warped
+        return out
+
+    def __call__(self, images, random_state, out=None):
+        """
+
+        Args:
+            images: array of shape (N, height, width)
+            random_state: numpy.random.RandomState
+            out: array of shape (N, height, width) written to, allocated if None
+
+        Returns:
+            randomly transformed images
+        """
+        matrices = self.sample_matrices(len(images), images.shape[1:], random_state)
+        return self.warp(images, matrices, out)
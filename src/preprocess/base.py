@@ -9,10 +9,13 @@ import os
 import cv2
 import dlib
 import numpy as np
-from keras.preprocessing.image import ImageDataGenerator
 from sklearn.utils import shuffle
 
+from config import IMAGE_CACHE_BYTES, DETECTION_SCALE
+from preprocess.augmentation import BatchAugmenter
 from preprocess.feature_extraction import ImageFeatureExtractor
+from preprocess.image_cache import ImageLRUCache
+from preprocess.packed import is_packed_dataset, load_packed_split
 
 
 class Preprocessor(object):
@@ -44,17 +47,19 @@ class Preprocessor(object):
         self.called = False
         self.verbose = verbose
         self.augmentation = augmentation
+        self.random_state = np.random.RandomState()
         if augmentation:
-            self.data_generator = ImageDataGenerator(
+            self.augmenter = BatchAugmenter(
                 rotation_range=20,
                 width_shift_range=0.2,
                 height_shift_range=0.2,
-                # shear_range = 0.2,
                 zoom_range=0.2,
-                # horizontal_flip=True,
-
             )
         self.feature_extractor = ImageFeatureExtractor()
+        self.train_packed_images = None
+        self.image_cache = None
+        if IMAGE_CACHE_BYTES > 0:
+            self.image_cache = ImageLRUCache(IMAGE_CACHE_BYTES)
 
     def load_dataset(self, path):
         """Load dataset with given path
@@ -62,9 +67,13 @@ class Preprocessor(object):
         parameters
         ----------
         path    : str
-            path to directory containing training and test directory.
+            path to directory containing training and test directory, or to a data set packed
+            with preprocess.packed.
         """
         assert os.path.exists(path), "Specified dataset directory '" + path + "' does not exist "
+        if is_packed_dataset(path):
+            self.load_packed_dataset(path)
+            return
         train_test_dir = os.listdir(path)
         assert "train" in train_test_dir, "Specified dataset directory '" + path + "' does not contain train directory."
         assert "test" in train_test_dir, "Specified dataset directory '" + path + "' does not  contain test directory."
@@ -96,6 +105,27 @@ class Preprocessor(object):
                                                                           self.input_shape[2])
         self.test_image_emotions = np.eye(self.classifier.get_num_class())[np.array(self.test_image_emotions)]
 
+    def load_packed_dataset(self, path):
+        """Memory-maps the train images of a packed data set and loads its test images.
+
+        parameters
+        ----------
+        path    : str
+            path to directory written by preprocess.packed.pack_dataset
+        """
+        print("Loading packed dataset", path)
+        self.train_packed_images, train_emotions = load_packed_split(path, "train")
+        assert self.train_packed_images.shape[1:] == (self.input_shape[0], self.input_shape[1]), \
+            "Packed images of shape " + str(self.train_packed_images.shape[1:]) + " do not match input shape"
+        self.train_image_paths = None
+        self.train_image_emotions = np.array([self.classifier.get_class(emotion) for emotion in train_emotions])
+
+        test_images, test_emotions = load_packed_split(path, "test")
+        self.test_images = np.array(test_images).reshape(-1, self.input_shape[0], self.input_shape[1],
+                                                         self.input_shape[2])
+        test_emotions = np.array([self.classifier.get_class(emotion) for emotion in test_emotions])
+        self.test_image_emotions = np.eye(self.classifier.get_num_class())[test_emotions]
+
     def __call__(self, path):
         """
         Pre-process given path
@@ -120,7 +150,7 @@ class Preprocessor(object):
         """
         indexes = range(len(self.train_image_emotions))
         if random:
-            indexes = shuffle(indexes)
+            indexes = shuffle(indexes, random_state=self.random_state)
         indexes = np.array(indexes)
         return indexes
 
@@ -133,14 +163,13 @@ class Preprocessor(object):
             indexes = self.generate_indexes(True)
             for i in range(0, len(indexes) - self.batch_size, self.batch_size):
                 current_indexes = indexes[i:i + self.batch_size]
-                current_paths = self.train_image_paths[current_indexes]
                 current_emotions = self.train_image_emotions[current_indexes]
-                current_images = self.get_images(current_paths, self.augmentation).reshape(-1, self.input_shape[0],
-                                                                                           self.input_shape[1],
-                                                                                           self.input_shape[2])
+                current_images = self.get_train_images(current_indexes, self.augmentation).reshape(
+                    -1, self.input_shape[0], self.input_shape[1], self.input_shape[2])
                 current_images = self.feature_extractor.extract(current_images)
                 current_emotions = np.eye(self.classifier.get_num_class())[current_emotions]
                 yield current_images, current_emotions
+            self.report_image_cache()
 
     def sanitize(self, image):
         """
@@ -158,39 +187,86 @@ class Preprocessor(object):
         image = cv2.resize(image, (self.input_shape[0], self.input_shape[1]))
         return image
 
-    def get_images(self, paths, augmentation=False):
+    def get_train_images(self, indexes, augmentation=False):
+        """
+        Sanitized train images at the given indexes, sliced from the packed data set if one is loaded.
+
+        Args:
+            indexes:
+            augmentation:
+
+        Returns:
+
+        """
+        if self.train_packed_images is None:
+            return self.get_images(self.train_image_paths[indexes], augmentation, cache=True)
+        # sorted indexes keep memmap reads sequential, the batch is put back in the shuffled order afterwards
+        order = np.argsort(indexes)
+        output = np.empty((len(indexes), self.input_shape[0], self.input_shape[1]), dtype=np.uint8)
+        output[order] = self.train_packed_images[np.asarray(indexes)[order]]
+        if augmentation:
+            output = self.augment_images(output, out=output)
+        return output
+
+    def augment_images(self, images, out=None):
+        """
+        Randomly rotates, shifts and zooms the whole batch at once.
+
+        Args:
+            images: uint8 images of shape (N, height, width)
+            out: buffer of the same shape receiving the augmented images, may be images itself, allocated if None
+
+        Returns:
+
+        """
+        return self.augmenter(images, self.random_state, out)
+
+    def get_images(self, paths, augmentation=False, cache=False):
         """
 
         Args:
             paths:
             augmentation:
+            cache: go through the image cache, only the train images are read more than once
 
         Returns:
 
         """
+        image_cache = self.image_cache if cache else None
         output = np.zeros(shape=(len(paths), self.input_shape[0], self.input_shape[1]), dtype=np.uint8)
         for i in range(len(paths)):
-            img = cv2.imread(paths[i])
-            img = self.sanitize(img)
-            if (augmentation):
-                img_shape = img.shape
-                img = img.reshape((-1, img_shape[0], img_shape[1]))
-                img = self.data_generator.random_transform(img)
-                img = img.reshape((img_shape[0], img_shape[1]))
+            img = None
+            if image_cache is not None:
+                img = image_cache.get(paths[i])
+            if img is None:
+                img = self.sanitize(cv2.imread(paths[i]))
+                if image_cache is not None:
+                    image_cache.put(paths[i], img)
             output[i] = img
+        # augmentation works in place on the copies in output, cached images stay untouched
+        if augmentation:
+            output = self.augment_images(output, out=output)
         return output
 
-    def get_faces(self, frame, detector):
+    def report_image_cache(self):
+        """
+        Prints the statistics of the image cache, called by the flows once per epoch.
+        """
+        if self.verbose and self.image_cache is not None:
+            print("Image cache", self.image_cache.stats())
+
+    def get_faces(self, frame, detector, scale=DETECTION_SCALE):
         """
 
         Args:
             frame:
             detector:
+            scale: the detector runs on a copy of frame resized by scale, faces are cropped from frame itself
 
         Returns:
 
         """
-        faces = detector(frame)
+        faces = self.detect_faces(frame, detector, scale)
         output = []
         rectangles = []
         for face in faces:
@@ -202,6 +278,25 @@ class Preprocessor(object):
             output.append(frame[top:bottom, left:right])
         return output, rectangles
 
+    def detect_faces(self, frame, detector, scale=DETECTION_SCALE):
+        """
+        Runs detector on frame downsampled by scale and maps the rectangles back to frame coordinates.
+
+        Args:
+            frame:
+            detector:
+            scale:
+
+        Returns:
+            list of dlib.rectangle in frame coordinates
+        """
+        if scale == 1:
+            return detector(frame)
+        small_frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)),
+                                 interpolation=cv2.INTER_AREA)
+        return [dlib.rectangle(int(face.left() / scale), int(face.top() / scale), int(face.right() / scale),
+                               int(face.bottom() / scale)) for face in detector(small_frame)]
+
     def load_sequencial_dataset(self, path, max_sequence_length=71):
         """
 
@@ -1,7 +1,60 @@
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
 import dlib
 import numpy as np
 
-from config import IMG_SIZE
+from config import IMG_SIZE, SHAPE_PREDICTOR_PATH, LANDMARK_WORKERS, LANDMARK_WORKER_TYPE
+
+_landmark_worker_state = threading.local()
+
+
+def face_dlib_points(predictor, image):
+    """
+    Runs the shape predictor on a whole face image.
+
+    Args:
+        predictor: dlib.shape_predictor
+        image: face image of size IMG_SIZE
+
+    Returns:
+        array of shape (68, 2)
+    """
+    face = dlib.rectangle(0, 0, image.shape[1] - 1, image.shape[0] - 1)
+    img = image.reshape(IMG_SIZE[0], IMG_SIZE[1])
+    shapes = predictor(img, face)
+    parts = shapes.parts()
+    output = np.zeros((68, 2))
+    for i, point in enumerate(parts):
+        output[i] = [point.x, point.y]
+    return output
+
+
+def _init_landmark_worker(predictor_path):
+    """
+    Loads the shape predictor once per pool worker.
+
+    Args:
+        predictor_path:
+    """
+    _landmark_worker_state.predictor = dlib.shape_predictor(predictor_path)
+
+
+def _landmark_worker(images):
+    """
+    Extracts the dlib points of a slice of a batch inside a pool worker.
+
+    Args:
+        images:
+
+    Returns:
+        array of shape (len(images), 68, 2)
+    """
+    output = np.zeros((len(images), 68, 2))
+    for i in range(len(images)):
+        output[i] = face_dlib_points(_landmark_worker_state.predictor, images[i])
+    return output
 
 
 class FeatureExtractor(object):
@@ -52,15 +105,49 @@ class DlibFeatureExtractor(FeatureExtractor):
     """
     """
 
-    def __init__(self, predictor, **kwargs):
+    def __init__(self, predictor, workers=LANDMARK_WORKERS, worker_type=LANDMARK_WORKER_TYPE,
+                 predictor_path=SHAPE_PREDICTOR_PATH, landmark_cache=None, **kwargs):
         """
 
         Args:
             predictor:
+            workers: number of pool workers extracting dlib points, 0 or 1 extracts them in the calling thread
+            worker_type: either "thread" or "process"
+            predictor_path: shape predictor loaded by every pool worker
+            landmark_cache: preprocess.landmark_cache.LandmarkCache, if given dlib points are only computed for
+                images missing from it
             kwargs:
         """
         FeatureExtractor.__init__(self, **kwargs)
+        assert worker_type in ["thread", "process"], "Landmark worker type must be either thread or process"
         self.predictor = predictor
+        self.workers = workers
+        self.worker_type = worker_type
+        self.predictor_path = predictor_path
+        self.pool = None
+        self.landmark_cache = landmark_cache
+
+    def get_pool(self):
+        """
+        Lazily starts the landmark worker pool.
+
+        Returns:
+            multiprocessing.Pool or multiprocessing.pool.ThreadPool
+        """
+        if self.pool is None:
+            pool_class = ThreadPool if self.worker_type == "thread" else Pool
+            self.pool = pool_class(self.workers, initializer=_init_landmark_worker,
+                                   initargs=(self.predictor_path,))
+        return self.pool
+
+    def close(self):
+        """
+        Stops the landmark worker pool if it was started.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
 
     def get_dlib_points(self, image):
         """
@@ -71,15 +158,8 @@ class DlibFeatureExtractor(FeatureExtractor):
         Returns:
 
         """
-        face = dlib.rectangle(0, 0, image.shape[1] - 1, image.shape[0] - 1)
-        img = image.reshape(IMG_SIZE[0], IMG_SIZE[1])
-        shapes = self.predictor(img, face)
-        parts = shapes.parts()
-        output = np.zeros((68, 2))
-        for i, point in enumerate(parts):
-            output[i] = [point.x, point.y]
-        output = np.array(output).reshape((1, 68, 2))
-        return output
+        output = face_dlib_points(self.predictor, image)
+        return output.reshape((1, 68, 2))
 
     def to_dlib_points(self, images):
         """
@@ -90,46 +170,81 @@ class DlibFeatureExtractor(FeatureExtractor):
         Returns:
 
         """
+        if self.landmark_cache is None:
+            output = self.compute_dlib_points(images)
+        else:
+            keys = [self.landmark_cache.key(image) for image in images]
+            output, missing = self.landmark_cache.lookup(keys)
+            if len(missing) > 0:
+                missing_points = self.compute_dlib_points(images[missing]).reshape((-1, 68, 2))
+                output[missing] = missing_points
+                self.landmark_cache.add([keys[i] for i in missing], missing_points)
+            output = output.reshape((-1, 1, 68, 2))
+        centroids = self.get_centroids(output)
+        return output, centroids
+
+    def compute_dlib_points(self, images):
+        """
+        Runs the shape predictor on every image, in the worker pool if one is configured.
+
+        Args:
+            images:
+
+        Returns:
+            array of shape (len(images), 1, 68, 2)
+        """
+        if self.workers > 1 and len(images) > 1:
+            # each worker gets one contiguous slice, map keeps the slices in order
+            slice_size = int(np.ceil(len(images) / float(self.workers)))
+            slices = [images[i:i + slice_size] for i in range(0, len(images), slice_size)]
+            return np.concatenate(self.get_pool().map(_landmark_worker, slices)).reshape((-1, 1, 68, 2))
         output = np.zeros((len(images), 1, 68, 2))
-        centroids = np.zeros((len(images), 2))
         for i in range(len(images)):
-            dlib_points = self.get_dlib_points(images[i])[0]
-            centroid = np.mean(dlib_points, axis=0)
-            centroids[i] = centroid
-            output[i][0] = dlib_points
-        return output, centroids
+            output[i][0] = self.get_dlib_points(images[i])[0]
+        return output
 
-    def get_distances_angles(self, all_dlib_points, centroids):
+    def get_centroids(self, all_dlib_points):
         """
+        Computes the centroid of every face of a batch of dlib points at once.
 
         Args:
-            all_dlib_points:
-            centroids:
+            all_dlib_points: array of shape (N, 68, 2) or (N, 1, 68, 2)
 
         Returns:
+            array of shape (N, 2)
+        """
+        return np.mean(np.reshape(all_dlib_points, (-1, 68, 2)), axis=1)
+
+    def get_distances_angles(self, all_dlib_points, centroids):
+        """
+        Computes distances and angles of the dlib points with respect to the centroid of their face for the
+        whole batch at once.
 
+        Args:
+            all_dlib_points: array of shape (N, 68, 2) or (N, 1, 68, 2)
+            centroids: array of shape (N, 2)
+
+        Returns:
+            distances and angles, both of shape (N, 1, 68, 1)
         """
-        all_distances = np.zeros((len(all_dlib_points), 1, 68, 1))
-        all_angles = np.zeros((len(all_dlib_points), 1, 68, 1))
-        for i in range(len(all_dlib_points)):
-            dists = np.linalg.norm(centroids[i] - all_dlib_points[i][0], axis=1)
-            angles = self.get_angles(all_dlib_points[i][0], centroids[i])
-            all_distances[i][0] = dists.reshape(1, 68, 1)
-            all_angles[i][0] = angles.reshape(1, 68, 1)
+        points = np.reshape(all_dlib_points, (-1, 68, 2))
+        centroids = np.reshape(centroids, (-1, 1, 2))
+        all_distances = np.linalg.norm(centroids - points, axis=2).reshape(-1, 1, 68, 1)
+        all_angles = self.angle_between(points, centroids).reshape(-1, 1, 68, 1)
         return all_distances, all_angles
 
     def angle_between(self, p1, p2):
         """
 
         Args:
-            p1:
-            p2:
+            p1: point or array of points, last axis is (x, y)
+            p2: point or array of points, last axis is (x, y)
 
         Returns:
 
         """
-        ang1 = np.arctan2(*p1[::-1])
-        ang2 = np.arctan2(*p2[::-1])
+        ang1 = np.arctan2(p1[..., 1], p1[..., 0])
+        ang2 = np.arctan2(p2[..., 1], p2[..., 0])
         return (ang1 - ang2) % (2 * np.pi)
 
     def get_angles(self, dlib_points, centroid):
@@ -142,37 +257,42 @@ class DlibFeatureExtractor(FeatureExtractor):
         Returns:
 
         """
-        output = np.zeros((68))
-        for i in range(68):
-            angle = self.angle_between(dlib_points[i], centroid)
-            output[i] = angle
-        return output
+        return self.angle_between(np.reshape(dlib_points, (68, 2)), np.asarray(centroid))
 
-    def extract(self, images):
+    def get_geometry(self, all_dlib_points):
         """
+        Normalized dlib points, distances and angles of a batch of landmarks, exactly as returned by `extract`.
 
         Args:
-            images:
+            all_dlib_points: array of shape (N, 68, 2) or (N, 1, 68, 2) in image coordinates
 
         Returns:
-
+            dlib points (N, 1, 68, 2), distances (N, 1, 68, 1) and angles (N, 1, 68, 1)
         """
-
-        dlib_points, centroids = self.to_dlib_points(images)
-
-        distances, angles = self.get_distances_angles(dlib_points, centroids)
+        all_dlib_points = np.reshape(all_dlib_points, (-1, 1, 68, 2)).astype(float)
+        centroids = self.get_centroids(all_dlib_points)
+        distances, angles = self.get_distances_angles(all_dlib_points, centroids)
 
         IMAGE_CENTER = np.array(IMG_SIZE) / 2
         IMG_WIDTH = IMG_SIZE[1]
         # normalize
-        dlib_points = (dlib_points - IMAGE_CENTER) / IMG_WIDTH
-        dlib_points = dlib_points.reshape((-1, 1, 68, 2))
+        dlib_points = (all_dlib_points - IMAGE_CENTER) / IMG_WIDTH
+        distances /= 50.0
+        angles /= (2 * np.pi)
+        return dlib_points, distances, angles
+
+    def extract(self, images):
+        """
 
-        distances /= 50.0;
-        distances = distances.reshape(-1, 1, 68, 1)
+        Args:
+            images:
 
-        angles /= (2 * np.pi)
-        angles = angles.reshape(-1, 1, 68, 1)
+        Returns:
+
+        """
+
+        dlib_points, _ = self.to_dlib_points(images)
+        dlib_points, distances, angles = self.get_geometry(dlib_points)
         images = images.astype(np.float32) / 255
 
         return images, dlib_points, distances, angles
@@ -0,0 +1,87 @@
+"""
+In-memory least recently used cache of decoded and sanitized images.
+"""
+import threading
+from collections import OrderedDict
+
+
+class ImageLRUCache(object):
+    """
+    LRU cache whose budget is a number of bytes rather than a number of entries.
+
+    parameters
+    ----------
+    max_bytes : int
+        maximum total size of the cached images, images larger than this are never cached
+    """
+
+    def __init__(self, max_bytes):
+        """
+
+        Args:
+            max_bytes:
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """
+
+        Returns:
+            number of cached images
+        """
+        return len(self.images)
+
+    def get(self, key):
+        """
+
+        Args:
+            key:
+
+        Returns:
+            the cached image, read only, or None on a miss
+        """
+        with self.lock:
+            image = self.images.pop(key, None)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images[key] = image
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """
+
+        Args:
+            key:
+            image: numpy array, cached without copying and made read only
+        """
+        if image.nbytes > self.max_bytes:
+            return
+        image.setflags(write=False)
+        with self.lock:
+            old_image = self.images.pop(key, None)
+            if old_image is not None:
+                self.current_bytes -= old_image.nbytes
+            self.images[key] = image
+            self.current_bytes += image.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        """
+
+        Returns:
+            dict with hits, misses, evictions, number of entries and bytes in use
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.images), "bytes": self.current_bytes, "max_bytes": self.max_bytes}
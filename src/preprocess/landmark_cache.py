@@ -0,0 +1,138 @@
+"""
+On-disk store of dlib points keyed by the content of the image they were extracted from.
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+class LandmarkCache(object):
+    """
+    Memory-mapped array of shape (capacity, 68, 2) holding dlib points plus an append-only index
+    mapping image hashes to rows of the array.
+
+    Lookups and additions are serialized by a lock, so threads of one process may share a cache. Processes must
+    not share a cache directory, each of them would claim the same rows.
+
+    parameters
+    ----------
+    cache_dir : str
+        directory containing `landmarks.npy` and `index.txt`, created if it does not exist
+    capacity : int
+        initial number of rows of the landmark array, the array doubles whenever it is full
+    """
+
+    def __init__(self, cache_dir, capacity=1024):
+        """
+
+        Args:
+            cache_dir:
+            capacity:
+        """
+        self.cache_dir = cache_dir
+        self.landmarks_path = os.path.join(cache_dir, "landmarks.npy")
+        self.index_path = os.path.join(cache_dir, "index.txt")
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.index[parts[0]] = int(parts[1])
+        if os.path.exists(self.landmarks_path):
+            self.landmarks = np.load(self.landmarks_path, mmap_mode="r+")
+        else:
+            self.landmarks = np.lib.format.open_memmap(self.landmarks_path, mode="w+", dtype=np.float32,
+                                                       shape=(capacity, 68, 2))
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """
+
+        Returns:
+            number of cached images
+        """
+        return len(self.index)
+
+    def key(self, image):
+        """
+
+        Args:
+            image:
+
+        Returns:
+            hex digest of the image shape, dtype and pixels
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha1(str((image.shape, image.dtype.str)).encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def lookup(self, keys):
+        """
+
+        Args:
+            keys: image keys as returned by `key`
+
+        Returns:
+            dlib points of shape (len(keys), 68, 2), missing rows are zero, and the positions of the missing keys
+        """
+        output = np.zeros((len(keys), 68, 2))
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                row = self.index.get(key)
+                if row is None:
+                    missing.append(i)
+                else:
+                    output[i] = self.landmarks[row]
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+        return output, missing
+
+    def add(self, keys, dlib_points):
+        """
+
+        Args:
+            keys: image keys as returned by `key`
+            dlib_points: array of shape (len(keys), 68, 2)
+        """
+        with self.lock:
+            new_rows = []
+            for key, points in zip(keys, np.reshape(dlib_points, (-1, 68, 2))):
+                if key in self.index:
+                    continue
+                row = len(self.index)
+                if row >= len(self.landmarks):
+                    self.grow()
+                self.landmarks[row] = points
+                self.index[key] = row
+                new_rows.append((key, row))
+            if len(new_rows) == 0:
+                return
+            # landmarks must reach the disk before the index rows pointing at them
+            self.landmarks.flush()
+            with open(self.index_path, "a") as index_file:
+                for key, row in new_rows:
+                    index_file.write(key + " " + str(row) + "\n")
+
+    def grow(self):
+        """
+        Doubles the capacity of the landmark array, called by `add` with the lock held.
+        """
+        old = self.landmarks
+        tmp_path = self.landmarks_path + ".tmp"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=old.dtype, shape=(2 * len(old), 68, 2))
+        grown[:len(old)] = old
+        grown.flush()
+        del grown
+        del old
+        self.landmarks = None
+        os.replace(tmp_path, self.landmarks_path)
+        self.landmarks = np.load(self.landmarks_path, mmap_mode="r+")
@@ -3,8 +3,10 @@ from __future__ import print_function
 import dlib
 import numpy as np
 
+from config import LANDMARK_CACHE_DIR
 from preprocess.base import Preprocessor
 from preprocess.feature_extraction import DlibFeatureExtractor
+from preprocess.landmark_cache import LandmarkCache
 
 
 class MultiInputPreprocessor(Preprocessor):
@@ -34,7 +36,10 @@ class MultiInputPreprocessor(Preprocessor):
         """
         Preprocessor.__init__(self, classifier, input_shape, batch_size, augmentation, verbose)
         self.predictor = dlib.shape_predictor()
-        self.feature_extractor = DlibFeatureExtractor(self.predictor)
+        landmark_cache = None
+        if LANDMARK_CACHE_DIR is not None and not augmentation:
+            landmark_cache = LandmarkCache(LANDMARK_CACHE_DIR)
+        self.feature_extractor = DlibFeatureExtractor(self.predictor, landmark_cache=landmark_cache)
 
     def __call__(self, path):
         """
@@ -61,11 +66,10 @@ class MultiInputPreprocessor(Preprocessor):
             indexes = self.generate_indexes(True)
             for i in range(0, len(indexes) - self.batch_size, self.batch_size):
                 current_indexes = indexes[i:i + self.batch_size]
-                current_paths = self.train_image_paths[current_indexes]
                 current_emotions = self.train_image_emotions[current_indexes]
-                current_images = self.get_images(current_paths, self.augmentation).reshape(-1, self.input_shape[0],
-                                                                                           self.input_shape[1],
-                                                                                           self.input_shape[2])
+                current_images = self.get_train_images(current_indexes, self.augmentation).reshape(
+                    -1, self.input_shape[0], self.input_shape[1], self.input_shape[2])
                 current_images, dpoints, dpointsDists, dpointsAngles = self.feature_extractor.extract(current_images)
                 current_emotions = np.eye(self.classifier.get_num_class())[current_emotions]
                 yield [current_images, dpoints, dpointsDists, dpointsAngles], current_emotions
+            self.report_image_cache()
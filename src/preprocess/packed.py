@@ -0,0 +1,126 @@
+# coding=utf-8
+"""
+Packed data set format: the sanitized images of a `train/<emotion>` and `test/<emotion>` directory tree
+stored as one contiguous uint8 array per split, plus the emotion label of every image.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+
+import cv2
+import numpy as np
+
+PACKED_SPLITS = ["train", "test"]
+
+
+def get_packed_paths(path, split):
+    """
+
+    Args:
+        path: directory of the packed data set
+        split: either train or test
+
+    Returns:
+        paths of the image array and of the label array of the split
+    """
+    return os.path.join(path, split + "_images.npy"), os.path.join(path, split + "_labels.npy")
+
+
+def is_packed_dataset(path):
+    """
+
+    Args:
+        path:
+
+    Returns:
+        True if path contains a packed train and test split
+    """
+    for split in PACKED_SPLITS:
+        for packed_path in get_packed_paths(path, split):
+            if not os.path.exists(packed_path):
+                return False
+    return True
+
+
+def list_split(path, split):
+    """
+
+    Args:
+        path: directory containing the split directory
+        split: either train or test
+
+    Returns:
+        sorted image paths and their emotion directory names
+    """
+    image_paths = []
+    emotions = []
+    for emotion in sorted(os.listdir(os.path.join(path, split))):
+        for img_file in sorted(os.listdir(os.path.join(path, split, emotion))):
+            image_paths.append(os.path.join(path, split, emotion, img_file))
+            emotions.append(emotion)
+    return image_paths, emotions
+
+
+def pack_dataset(preprocessor, path, output_dir):
+    """
+    Decodes and sanitizes every image of the data set once and writes the packed splits to output_dir.
+
+    Args:
+        preprocessor: preprocess.base.Preprocessor whose sanitize and input_shape are used
+        path: directory containing train and test directory
+        output_dir: directory of the packed data set
+    """
+    assert os.path.exists(path), "Specified dataset directory '" + path + "' does not exist "
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for split in PACKED_SPLITS:
+        image_paths, emotions = list_split(path, split)
+        images_path, labels_path = get_packed_paths(output_dir, split)
+        images = np.lib.format.open_memmap(images_path, mode="w+", dtype=np.uint8,
+                                           shape=(len(image_paths), preprocessor.input_shape[0],
+                                                  preprocessor.input_shape[1]))
+        for i in range(len(image_paths)):
+            images[i] = preprocessor.sanitize(cv2.imread(image_paths[i]))
+        images.flush()
+        del images
+        np.save(labels_path, np.array(emotions))
+        print("Packed", len(image_paths), split, "images to", images_path)
+
+
+def load_packed_split(path, split):
+    """
+
+    Args:
+        path: directory of the packed data set
+        split: either train or test
+
+    Returns:
+        memory-mapped images of shape (N, height, width) and emotion names of shape (N,)
+    """
+    images_path, labels_path = get_packed_paths(path, split)
+    images = np.load(images_path, mmap_mode="r")
+    emotions = np.load(labels_path)
+    assert len(images) == len(emotions), "number of packed " + split + " images is not equal to labels"
+    return images, emotions
+
+
+def main():
+    """
+    Packs a train/test image directory data set.
+    """
+    from config import IMG_SIZE, DATA_SET_DIR
+    from preprocess.base import Preprocessor
+    from util import SevenEmotionsClassifier
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_set_dir", default=DATA_SET_DIR, type=str)
+    parser.add_argument("--out", required=True, type=str)
+
+    args = parser.parse_args()
+    pack_dataset(Preprocessor(SevenEmotionsClassifier(), input_shape=(IMG_SIZE[0], IMG_SIZE[1], 1)),
+                 args.data_set_dir, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Background prefetching of the batches generated by the `flow` method of the preprocessors.
+"""
+from __future__ import print_function
+
+import copy
+import multiprocessing
+import threading
+import traceback
+
+import numpy as np
+
+from config import PREFETCH_WORKERS, PREFETCH_WORKER_TYPE, PREFETCH_QUEUE_SIZE, PREFETCH_SEED
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class PrefetchWorkerError(object):
+    """
+    Put on the queue by a worker whose flow raised, carries the formatted traceback.
+    """
+
+    def __init__(self, worker_id, trace):
+        """
+
+        Args:
+            worker_id:
+            trace:
+        """
+        self.worker_id = worker_id
+        self.trace = trace
+
+
+def worker_preprocessor(preprocessor, worker_type):
+    """
+    Copy of preprocessor for one worker. The feature extractor is copied too, so every worker starts its own
+    landmark pool. Thread workers share the landmark cache, whose lock serializes them, process workers get none
+    as their rows would collide in the shared cache files.
+
+    Args:
+        preprocessor: called preprocessor
+        worker_type: either "thread" or "process"
+
+    Returns:
+        the copy
+    """
+    worker = copy.copy(preprocessor)
+    worker.feature_extractor = copy.copy(preprocessor.feature_extractor)
+    if hasattr(worker.feature_extractor, "pool"):
+        worker.feature_extractor.pool = None
+    if worker_type == "process" and getattr(worker.feature_extractor, "landmark_cache", None) is not None:
+        worker.feature_extractor.landmark_cache = None
+    return worker
+
+
+def _run_worker(preprocessor, worker_id, seed, batches, stop_event, reseed_global):
+    """
+    Puts the batches of the flow of preprocessor on the queue until stop_event is set.
+
+    Args:
+        preprocessor: called preprocessor whose flow generates the batches
+        worker_id:
+        seed: seed of the shuffling and augmentation of this worker
+        batches: bounded queue shared with the consumer
+        stop_event:
+        reseed_global: also seed the global numpy generator, only safe when the worker owns the process
+    """
+    try:
+        preprocessor.random_state = np.random.RandomState(seed)
+        if reseed_global:
+            np.random.seed(seed)
+        for batch in preprocessor.flow():
+            while not stop_event.is_set():
+                try:
+                    batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop_event.is_set():
+                return
+    except Exception:
+        batches.put(PrefetchWorkerError(worker_id, traceback.format_exc()))
+    finally:
+        if hasattr(preprocessor.feature_extractor, "close"):
+            preprocessor.feature_extractor.close()
+
+
+class PrefetchFlow(object):
+    """
+    Generator running the flow of a preprocessor in several producer workers and serving their batches
+    through a bounded queue, so batch building overlaps with the model step.
+
+    Every worker owns a copy of the preprocessor and of its feature extractor, see `worker_preprocessor`, whose
+    shuffling and augmentation are seeded with `seed + worker_id`. Process workers also seed the global numpy
+    generator and do not use the landmark cache. With the "process" worker type the preprocessor is inherited by
+    fork, or pickled on platforms without fork.
+
+    parameters
+    ----------
+    preprocessor : preprocess.base.Preprocessor
+        preprocessor that has already been called with the data set path
+    workers : int
+        number of producer workers
+    worker_type : str
+        either "thread" or "process"
+    queue_size : int
+        maximum number of batches waiting in the queue
+    seed : int
+        base seed of the workers, a random one is drawn if None
+    """
+
+    def __init__(self, preprocessor, workers=PREFETCH_WORKERS, worker_type=PREFETCH_WORKER_TYPE,
+                 queue_size=PREFETCH_QUEUE_SIZE, seed=PREFETCH_SEED):
+        """
+
+        Args:
+            preprocessor:
+            workers:
+            worker_type:
+            queue_size:
+            seed:
+        """
+        assert preprocessor.called, "Preprocessor should be called with path of dataset first to use flow method."
+        assert worker_type in ["thread", "process"], "Prefetch worker type must be either thread or process"
+        assert workers > 0, "Prefetching needs at least one worker"
+        if seed is None:
+            seed = np.random.randint(0, 2 ** 31 - workers)
+        self.seed = seed
+        self.worker_type = worker_type
+        if worker_type == "thread":
+            self.batches = queue.Queue(maxsize=queue_size)
+            self.stop_event = threading.Event()
+        else:
+            self.batches = multiprocessing.Queue(maxsize=queue_size)
+            self.stop_event = multiprocessing.Event()
+        if worker_type == "process" and getattr(preprocessor.feature_extractor, "landmark_cache", None) is not None:
+            print("Process prefetch workers do not share the landmark cache, dlib points are computed again")
+        self.workers = []
+        for worker_id in range(workers):
+            args = (worker_preprocessor(preprocessor, worker_type), worker_id, seed + worker_id, self.batches,
+                    self.stop_event, worker_type == "process")
+            if worker_type == "thread":
+                worker = threading.Thread(target=_run_worker, args=args)
+            else:
+                worker = multiprocessing.Process(target=_run_worker, args=args)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __iter__(self):
+        """
+
+        Returns:
+
+        """
+        return self
+
+    def __next__(self):
+        """
+
+        Returns:
+            next batch built by any of the workers
+        """
+        while True:
+            try:
+                batch = self.batches.get(timeout=1.0)
+            except queue.Empty:
+                if any(worker.is_alive() for worker in self.workers):
+                    continue
+                # the error of a worker may reach the queue after the worker exited
+                try:
+                    batch = self.batches.get(timeout=1.0)
+                except queue.Empty:
+                    self.close()
+                    raise Exception(self.exit_message())
+            if isinstance(batch, PrefetchWorkerError):
+                self.close()
+                raise Exception("Prefetch worker " + str(batch.worker_id) + " failed:\n" + batch.trace)
+            return batch
+
+    next = __next__
+
+    def exit_message(self):
+        """
+
+        Returns:
+            why the workers stopped when none of them reported an error
+        """
+        crashed = [str(worker_id) + " (exit code " + str(worker.exitcode) + ")"
+                   for worker_id, worker in enumerate(self.workers) if getattr(worker, "exitcode", None)]
+        if len(crashed) > 0:
+            return "Prefetch workers crashed: " + ", ".join(crashed)
+        return "All prefetch workers stopped without reporting an error"
+
+    def close(self):
+        """
+        Stops the workers.
+        """
+        self.stop_event.set()
+        for worker in self.workers:
+            if self.worker_type == "process":
+                worker.terminate()
+            worker.join(1.0)
+
+
+def prefetch_flow(preprocessor):
+    """
+    Flow of preprocessor, prefetched in the background if PREFETCH_WORKERS is set in config.
+
+    Args:
+        preprocessor: called preprocessor
+
+    Returns:
+        generator of training batches
+    """
+    if PREFETCH_WORKERS > 0:
+        return PrefetchFlow(preprocessor)
+    return preprocessor.flow()
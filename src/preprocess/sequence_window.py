@@ -0,0 +1,137 @@
+"""
+Rolling windows of per-frame features for sequence inference on streams.
+"""
+import numpy as np
+
+
+class SequenceWindow(object):
+    """
+    Ring buffer of the last `max_sequence_length` frames. Every frame is stored at two positions of a buffer
+    twice the window length, so the current window is always a contiguous view and nothing is reallocated,
+    shifted or zeroed.
+
+    parameters
+    ----------
+    max_sequence_length : int
+        number of frames in a window
+    frame_shape : tuple
+        shape of the features of one frame
+    stride : int
+        number of new frames between two windows ready for prediction
+    """
+
+    def __init__(self, max_sequence_length=10, frame_shape=(68, 2, 1), stride=1, dtype=np.float32):
+        """
+
+        Args:
+            max_sequence_length:
+            frame_shape:
+            stride:
+            dtype:
+        """
+        assert stride > 0, "Stride must be at least one frame"
+        self.max_sequence_length = max_sequence_length
+        self.stride = stride
+        self.buffer = np.zeros((2 * max_sequence_length,) + tuple(frame_shape), dtype=dtype)
+        self.count = 0
+
+    def reset(self):
+        """
+        Starts a new sequence, the old frames are overwritten as new ones arrive.
+        """
+        self.count = 0
+
+    def push(self, frame):
+        """
+
+        Args:
+            frame: features of the new frame
+
+        Returns:
+            True if a new window is ready for prediction
+        """
+        position = self.count % self.max_sequence_length
+        self.buffer[position] = frame
+        self.buffer[position + self.max_sequence_length] = frame
+        self.count += 1
+        return self.is_ready()
+
+    def is_ready(self):
+        """
+
+        Returns:
+            True if the window is full and stride frames arrived since the previous ready window
+        """
+        if self.count < self.max_sequence_length:
+            return False
+        return (self.count - self.max_sequence_length) % self.stride == 0
+
+    def window(self):
+        """
+
+        Returns:
+            view of the last max_sequence_length frames, oldest first
+        """
+        start = self.count % self.max_sequence_length
+        return self.buffer[start:start + self.max_sequence_length]
+
+
+class SequenceWindows(object):
+    """
+    One SequenceWindow per tracked face.
+
+    parameters
+    ----------
+    max_sequence_length : int
+    frame_shape : tuple
+    stride : int
+    """
+
+    def __init__(self, max_sequence_length=10, frame_shape=(68, 2, 1), stride=1):
+        """
+
+        Args:
+            max_sequence_length:
+            frame_shape:
+            stride:
+        """
+        self.max_sequence_length = max_sequence_length
+        self.frame_shape = frame_shape
+        self.stride = stride
+        self.windows = {}
+
+    def push(self, face_id, frame):
+        """
+
+        Args:
+            face_id:
+            frame:
+
+        Returns:
+            True if a new window of face_id is ready for prediction
+        """
+        if face_id not in self.windows:
+            self.windows[face_id] = SequenceWindow(self.max_sequence_length, self.frame_shape, self.stride)
+        return self.windows[face_id].push(frame)
+
+    def retain(self, face_ids):
+        """
+        Drops the windows of the faces that are no longer tracked.
+
+        Args:
+            face_ids:
+        """
+        for face_id in list(self.windows.keys()):
+            if face_id not in face_ids:
+                del self.windows[face_id]
+
+    def batch(self, face_ids):
+        """
+
+        Args:
+            face_ids:
+
+        Returns:
+            array of shape (len(face_ids), max_sequence_length) + frame_shape
+        """
+        return np.stack([self.windows[face_id].window() for face_id in face_ids])
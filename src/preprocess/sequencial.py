@@ -147,7 +147,7 @@ class SequencialPreprocessor(Preprocessor):
         """
         indexes = range(len(self.train_sequences))
         if (random):
-            indexes = shuffle(indexes)
+            indexes = shuffle(indexes, random_state=self.random_state)
         indexes = np.array(indexes)
         return indexes
 
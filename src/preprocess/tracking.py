@@ -0,0 +1,136 @@
+"""
+Detect-then-track face localization for live streams.
+"""
+import dlib
+
+from config import FACE_TRACKING_INTERVAL, FACE_TRACKING_MIN_CONFIDENCE
+
+
+def overlap(rect1, rect2):
+    """
+
+    Args:
+        rect1: dlib.rectangle
+        rect2: dlib.rectangle
+
+    Returns:
+        intersection over union of the two rectangles
+    """
+    intersection = rect1.intersect(rect2)
+    if intersection.is_empty():
+        return 0.0
+    intersection_area = float(intersection.area())
+    return intersection_area / (rect1.area() + rect2.area() - intersection_area)
+
+
+class FaceTracker(object):
+    """
+    Runs the face detector every `detect_interval` frames, or as soon as a tracked face is lost or drifts out of
+    the frame, and follows the faces with dlib correlation trackers in between. Tracked rectangles are clipped to
+    the frame.
+
+    A tracker is called like the dlib detector it wraps, so `Preprocessor.get_faces(frame, tracker)` keeps
+    returning the cropped faces and their rectangles. `face_ids` holds a stable id for each of the
+    rectangles of the last frame.
+
+    parameters
+    ----------
+    detector : dlib.fhog_object_detector
+    detect_interval : int
+        number of frames between two detections
+    min_confidence : float
+        peak to side lobe ratio under which a tracked face counts as lost
+    """
+
+    def __init__(self, detector, detect_interval=FACE_TRACKING_INTERVAL, min_confidence=FACE_TRACKING_MIN_CONFIDENCE):
+        """
+
+        Args:
+            detector:
+            detect_interval:
+            min_confidence:
+        """
+        assert detect_interval > 0, "Detection interval must be at least one frame"
+        self.detector = detector
+        self.detect_interval = detect_interval
+        self.min_confidence = min_confidence
+        self.trackers = []
+        self.face_ids = []
+        self.next_face_id = 0
+        self.frames_since_detection = detect_interval
+
+    def reset(self):
+        """
+        Forgets the tracked faces, the next frame is detected.
+        """
+        self.trackers = []
+        self.face_ids = []
+        self.frames_since_detection = self.detect_interval
+
+    def detect(self, frame):
+        """
+        Detects the faces and starts tracking them, keeping the id of faces overlapping a previously tracked one.
+
+        Args:
+            frame:
+
+        Returns:
+            list of dlib.rectangle
+        """
+        previous = [(face_id, self.to_rectangle(tracker.get_position()))
+                    for face_id, tracker in zip(self.face_ids, self.trackers)]
+        rectangles = list(self.detector(frame))
+        self.trackers = []
+        self.face_ids = []
+        for rectangle in rectangles:
+            best_id, best_overlap = None, 0.3
+            for face_id, previous_rectangle in previous:
+                current_overlap = overlap(rectangle, previous_rectangle)
+                if current_overlap > best_overlap and face_id not in self.face_ids:
+                    best_id, best_overlap = face_id, current_overlap
+            if best_id is None:
+                best_id = self.next_face_id
+                self.next_face_id += 1
+            tracker = dlib.correlation_tracker()
+            tracker.start_track(frame, rectangle)
+            self.trackers.append(tracker)
+            self.face_ids.append(best_id)
+        self.frames_since_detection = 1
+        return rectangles
+
+    def to_rectangle(self, position):
+        """
+
+        Args:
+            position: dlib.drectangle
+
+        Returns:
+            dlib.rectangle
+        """
+        return dlib.rectangle(int(round(position.left())), int(round(position.top())),
+                              int(round(position.right())), int(round(position.bottom())))
+
+    def __call__(self, frame):
+        """
+
+        Args:
+            frame:
+
+        Returns:
+            list of dlib.rectangle of the faces in frame
+        """
+        if self.frames_since_detection >= self.detect_interval:
+            return self.detect(frame)
+        self.frames_since_detection += 1
+        frame_rectangle = dlib.rectangle(0, 0, frame.shape[1] - 1, frame.shape[0] - 1)
+        rectangles = []
+        for tracker in self.trackers:
+            if tracker.update(frame) < self.min_confidence:
+                return self.detect(frame)
+            rectangle = self.to_rectangle(tracker.get_position())
+            # a face mostly out of the frame would be cropped to a sliver, or to nothing
+            visible = rectangle.intersect(frame_rectangle)
+            if visible.is_empty() or visible.area() < rectangle.area() / 2.0:
+                return self.detect(frame)
+            rectangles.append(visible)
+        return rectangles
@@ -1,22 +1,13 @@
-import cv2
-import dlib
-# from multiprocessing.queues import Queue
-# from threading import Thread
+# Nets, preprocessors and their cv2, dlib and keras dependencies are imported where they are used, so a job only
+# pays for the imports of the network type and session it runs.
 import numpy as np
-from nets.base import NeuralNet
-from nets.dlib_inputs import DlibPointsInputNeuralNet
-from nets.multinput import MultiInputNeuralNet
-from nets.rnn import LSTMNet, DlibLSTMNet
 
 from config import MODEL_PATH, TEST_TYPE, TEST_IMAGE, DATA_SET_DIR, EPOCHS, LEARNING_RATE, STEPS_PER_EPOCH, \
-    AUGMENTATION, BATCH_SIZE, NETWORK_TYPE
-from config import SESSION, IMG_SIZE
-from preprocess.base import Preprocessor
-from preprocess.dlib_input import DlibInputPreprocessor
-from preprocess.multinput import MultiInputPreprocessor
-from preprocess.sequencial import SequencialPreprocessor, DlibSequencialPreprocessor
+    AUGMENTATION, BATCH_SIZE, NETWORK_TYPE, TEST_VIDEO, TEST_VIDEO_OUTPUT, TEST_VIDEO_PREDICTIONS, VIDEO_BATCH_SIZE
+from config import SESSION, IMG_SIZE, FACE_TRACKING_INTERVAL, SEQUENCE_STRIDE, STREAMING_INFERENCE, \
+    STREAMING_MAX_FACES, INFERENCE_BACKEND
 from util import SevenEmotionsClassifier
-from util.BasePostprocessor import PostProcessor
+from util.stage_timing import timers
 
 maxSequenceLength = 10
 
@@ -39,20 +30,30 @@ def run_train():
     input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
     classifier = SevenEmotionsClassifier()
     if NETWORK_TYPE == "mi":
+        from nets.multinput import MultiInputNeuralNet
+        from preprocess.multinput import MultiInputPreprocessor
         preprocessor = MultiInputPreprocessor(classifier, input_shape=input_shape, augmentation=AUGMENTATION)
         neural_net = MultiInputNeuralNet(input_shape, preprocessor=preprocessor, train=True)
     elif NETWORK_TYPE == "si":
+        from nets.base import NeuralNet
+        from preprocess.base import Preprocessor
         preprocessor = Preprocessor(classifier, input_shape=input_shape, augmentation=AUGMENTATION)
         neural_net = NeuralNet(input_shape, preprocessor=preprocessor, train=True)
     elif NETWORK_TYPE == "rnn":
+        from nets.rnn import LSTMNet
+        from preprocess.sequencial import SequencialPreprocessor
         preprocessor = SequencialPreprocessor(classifier, input_shape=input_shape, augmentation=AUGMENTATION)(
             "dataset/ck-split")
         neural_net = LSTMNet(input_shape, preprocessor=preprocessor, train=True)
     elif NETWORK_TYPE == "drnn":
+        from nets.rnn import DlibLSTMNet
+        from preprocess.sequencial import DlibSequencialPreprocessor
         preprocessor = DlibSequencialPreprocessor(classifier, input_shape=input_shape, augmentation=AUGMENTATION)(
             "dataset/ck-split")
         neural_net = DlibLSTMNet(input_shape, preprocessor=preprocessor, train=True)
     elif NETWORK_TYPE == "dinn":
+        from nets.dlib_inputs import DlibPointsInputNeuralNet
+        from preprocess.dlib_input import DlibInputPreprocessor
         preprocessor = DlibInputPreprocessor(classifier, input_shape=input_shape, augmentation=AUGMENTATION)
         neural_net = DlibPointsInputNeuralNet(input_shape, preprocessor=preprocessor, train=True)
     else:
@@ -87,6 +88,7 @@ def draw_landmarks(frame, landmarks):
         frame:
         landmarks:
     """
+    import cv2
     for i in range(len(landmarks)):
         landmark = landmarks[i]
         cv2.circle(frame, (int(landmark[0]), int(landmark[1])), 1, color=(255, 0, 0), thickness=1)
@@ -96,38 +98,63 @@ def run_test():
     """
 
     """
+    import cv2
+    import dlib
+    from preprocess.base import Preprocessor
+    from preprocess.tracking import FaceTracker
+    from util.BasePostprocessor import PostProcessor
+
     input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
     classifier = SevenEmotionsClassifier()
     preprocessor = Preprocessor(classifier, input_shape=input_shape)
     postProcessor = PostProcessor(classifier)
-    neural_net = MultiInputNeuralNet(input_shape, preprocessor=preprocessor, learning_rate=1e-4, batch_size=1,
-                                     epochs=100, steps_per_epoch=1,
-                                     dataset_dir=TEST_IMAGE, train=False)
+    if TEST_TYPE != "webcam":
+        from nets.multinput import MultiInputNeuralNet
+        neural_net = MultiInputNeuralNet(input_shape, preprocessor=preprocessor, learning_rate=1e-4, batch_size=1,
+                                         epochs=100, steps_per_epoch=1,
+                                         dataset_dir=TEST_IMAGE, train=False)
+        if INFERENCE_BACKEND == "tflite":
+            neural_net.use_tflite(MODEL_PATH)
     face_detector = dlib.get_frontal_face_detector()
 
     if TEST_TYPE == "image":
-        img = cv2.imread(TEST_IMAGE)
-        faces, rectangles = preprocessor.get_faces(img, face_detector)
-        predictions = []
-        for i in range(len(faces)):
-            face = preprocessor.sanitize(faces[i])
-            predictions.append(neural_net.predict(face))
+        with timers.stage("read"):
+            img = cv2.imread(TEST_IMAGE)
+        with timers.stage("detect"):
+            faces, rectangles = preprocessor.get_faces(img, face_detector)
+        with timers.stage("sanitize"):
+            faces = [preprocessor.sanitize(face) for face in faces]
+        with timers.stage("predict"):
+            predictions = neural_net.predict_batch(faces)
         print("predicted")
 
-        postProcessor = postProcessor(img, rectangles, predictions)
+        with timers.stage("overlay"):
+            postProcessor = postProcessor(img, rectangles, predictions)
+        if timers.enabled:
+            timers.report()
         cv2.imshow("Image", img)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    elif TEST_TYPE == "video":  # TODO
-        pass
+    elif TEST_TYPE == "video":
+        from video_pipeline import VideoPipeline
+        pipeline = VideoPipeline(neural_net, preprocessor, face_detector, postprocessor=postProcessor,
+                                 batch_size=VIDEO_BATCH_SIZE)
+        pipeline.run(TEST_VIDEO, output_path=TEST_VIDEO_OUTPUT, predictions_path=TEST_VIDEO_PREDICTIONS)
     elif TEST_TYPE == "webcam":
         if NETWORK_TYPE == "drnn":
+            from nets.rnn import DlibLSTMNet
+            from preprocess.sequence_window import SequenceWindows
+            from preprocess.sequencial import DlibSequencialPreprocessor
             # cap = cv2.VideoCapture("/home/mtk/iCog/projects/emopy/test-videos/75Emotions.mp4")
             cap = cv2.VideoCapture(-1)
             preprocessor = DlibSequencialPreprocessor(classifier, input_shape=input_shape)
             neural_net = DlibLSTMNet(input_shape, preprocessor=preprocessor, train=False)
+            if INFERENCE_BACKEND == "tflite" and not STREAMING_INFERENCE:
+                neural_net.use_tflite("models/drnn/drnn-2")
             face_detector = dlib.get_frontal_face_detector()
+            if FACE_TRACKING_INTERVAL > 0:
+                face_detector = FaceTracker(face_detector)
             postProcessor = PostProcessor(classifier)
             # TODO Why is multi-threadding uncommented
             # if cap.isOpened():
@@ -136,80 +163,96 @@ def run_test():
             print
             "opening camera"
 
-            current_sequence = np.zeros((maxSequenceLength, 68, 2, 1))
-            currentIndex = 0
-
-            currentEmotion = ""
+            sequence_windows = SequenceWindows(maxSequenceLength, stride=SEQUENCE_STRIDE)
+            stream = neural_net.stream(STREAMING_MAX_FACES) if STREAMING_INFERENCE else None
+            current_emotions = {}
             while cap.isOpened():
-                ret, frame = cap.read()
-                currentWidth = frame.shape[1]
-                width = 600
-                ratio = currentWidth / float(width)
-                height = frame.shape[0] / float(ratio)
-                frame = cv2.resize(frame, (width, int(height)))
-                faces, rectangles = preprocessor.get_faces(frame, face_detector)
-                if (len(faces) > 0):
-                    face, rectangle = faces[0], rectangles[0]
-                    face = preprocessor.sanitize(face)
-                    dlib_points = preprocessor.get_face_dlib_points(face)
-                    # draw_landmarks(face,dlib_points)
-                    # cv2.imshow("Face",face)
-                    current_sequence[currentIndex:currentIndex + 2] = [np.array(np.expand_dims(dlib_points, 2)),
-                                                                       np.expand_dims(dlib_points, 2)]
-                    currentIndex += 2
-                    # sequencialQueue.put(face)
-                    postProcessor.overlay(frame, [rectangle], [currentEmotion])
+                with timers.stage("read"):
+                    ret, frame = cap.read()
+                with timers.stage("resize"):
+                    currentWidth = frame.shape[1]
+                    width = 600
+                    ratio = currentWidth / float(width)
+                    height = frame.shape[0] / float(ratio)
+                    frame = cv2.resize(frame, (width, int(height)))
+                with timers.stage("detect"):
+                    faces, rectangles = preprocessor.get_faces(frame, face_detector)
+                if isinstance(face_detector, FaceTracker):
+                    face_ids = face_detector.face_ids
                 else:
-                    current_sequence = np.zeros((maxSequenceLength, 68, 2, 1))
-                    currentIndex = 0
-                if currentIndex > maxSequenceLength - 2:
-                    current_sequence = current_sequence.astype(np.float32) / IMG_SIZE[0]
-                    predictions = neural_net.predict(np.expand_dims(current_sequence, 0))[0]
-                    print
-                    predictions
-                    emotion = arg_max(predictions)
-                    currentEmotion = preprocessor.classifier.get_string(emotion)
-                    current_sequence = np.zeros((maxSequenceLength, 68, 2, 1))
-                    currentIndex = 0
-                cv2.imshow("Webcam", frame)
-                if (cv2.waitKey(10) & 0xFF == ord('q')):
+                    face_ids = list(range(len(faces)))
+                sequence_windows.retain(face_ids)
+                current_emotions = {face_id: current_emotions[face_id] for face_id in face_ids
+                                    if face_id in current_emotions}
+                face_frames = {}
+                for face, face_id in zip(faces, face_ids):
+                    with timers.stage("sanitize"):
+                        face = preprocessor.sanitize(face)
+                    with timers.stage("landmarks"):
+                        face_frames[face_id] = np.expand_dims(preprocessor.get_face_dlib_points(face), 2) / IMG_SIZE[0]
+                with timers.stage("predict"):
+                    if stream is not None:
+                        stream.retain(face_ids)
+                        face_predictions = stream.step(face_frames)
+                    else:
+                        ready_face_ids = [face_id for face_id in face_ids
+                                          if sequence_windows.push(face_id, face_frames[face_id])]
+                        face_predictions = {}
+                        if len(ready_face_ids) > 0:
+                            predictions = neural_net.predict(sequence_windows.batch(ready_face_ids))
+                            face_predictions = dict(zip(ready_face_ids, predictions))
+                for face_id in face_predictions:
+                    current_emotions[face_id] = preprocessor.classifier.get_string(arg_max(face_predictions[face_id]))
+                with timers.stage("overlay"):
+                    emotions = [current_emotions.get(face_id, "") for face_id in face_ids]
+                    postProcessor.overlay(frame, rectangles, emotions)
+                with timers.stage("display"):
+                    cv2.imshow("Webcam", frame)
+                    key = cv2.waitKey(10)
+                timers.tick()
+                if (key & 0xFF == ord('q')):
                     break
             cv2.destroyAllWindows()
         else:
             # TODO fix static path
+            from nets.base import NeuralNet
             input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
             classifier = SevenEmotionsClassifier()
             preprocessor = Preprocessor(classifier, input_shape=input_shape)
             postProcessor = PostProcessor(classifier)
             neural_net = NeuralNet(input_shape, preprocessor=preprocessor, train=False)
             face_detector = dlib.get_frontal_face_detector()
+            if FACE_TRACKING_INTERVAL > 0:
+                face_detector = FaceTracker(face_detector)
             neural_net.load_model(MODEL_PATH)
+            if INFERENCE_BACKEND == "tflite":
+                neural_net.use_tflite(MODEL_PATH)
             # cap = cv2.VideoCapture(-1)
             cap = cv2.VideoCapture("/home/mtk/iCog/projects/emopy/test-videos/75Emotions.mp4")
             while cap.isOpened():
-                ret, frame = cap.read()
-                currentWidth = frame.shape[1]
-                width = 600
-                ratio = currentWidth / float(width)
-                height = frame.shape[0] / float(ratio)
-                frame = cv2.resize(frame, (width, int(height)))
-                faces, rectangles = preprocessor.get_faces(frame, face_detector)
+                with timers.stage("read"):
+                    ret, frame = cap.read()
+                with timers.stage("resize"):
+                    currentWidth = frame.shape[1]
+                    width = 600
+                    ratio = currentWidth / float(width)
+                    height = frame.shape[0] / float(ratio)
+                    frame = cv2.resize(frame, (width, int(height)))
+                with timers.stage("detect"):
+                    faces, rectangles = preprocessor.get_faces(frame, face_detector)
                 if (len(faces) > 0):
-                    emotions = []
-                    for i in range(len(faces)):
-                        print
-                        faces[i].shape
-                        face = preprocessor.sanitize(faces[i]).astype(np.float32) / 255;
-                        print
-                        face.shape
-                        predictions = neural_net.predict(face.reshape(-1, 48, 48, 1))[0]
-                        print
-                        predictions
-                        emotions.append(classifier.get_string(arg_max(predictions)))
-
-                    postProcessor.overlay(frame, rectangles, emotions)
-                cv2.imshow("Webcam", frame)
-                if (cv2.waitKey(10) & 0xFF == ord('q')):
+                    with timers.stage("sanitize"):
+                        faces = [preprocessor.sanitize(face) for face in faces]
+                    with timers.stage("predict"):
+                        predictions = neural_net.predict_batch(faces)
+                    emotions = [classifier.get_string(arg_max(prediction)) for prediction in predictions]
+                    with timers.stage("overlay"):
+                        postProcessor.overlay(frame, rectangles, emotions)
+                with timers.stage("display"):
+                    cv2.imshow("Webcam", frame)
+                    key = cv2.waitKey(10)
+                timers.tick()
+                if (key & 0xFF == ord('q')):
                     break
             cv2.destroyAllWindows()
 
@@ -230,6 +273,8 @@ def start_train_program(network_type=NETWORK_TYPE, dataset_dir=DATA_SET_DIR, epo
     input_shape = (IMG_SIZE[0], IMG_SIZE[1], 1)
     classifier = SevenEmotionsClassifier()
     if (network_type == "mi"):
+        from nets.multinput import MultiInputNeuralNet
+        from preprocess.multinput import MultiInputPreprocessor
         preprocessor = MultiInputPreprocessor(classifier, input_shape=input_shape, batch_size=batch_size,
                                               augmentation=augmentation)
         neural_net = MultiInputNeuralNet(input_shape, preprocessor=preprocessor,
@@ -237,18 +282,26 @@ def start_train_program(network_type=NETWORK_TYPE, dataset_dir=DATA_SET_DIR, epo
                                          dataset_dir=dataset_dir
                                          )
     elif network_type == "si":
+        from nets.base import NeuralNet
+        from preprocess.base import Preprocessor
         preprocessor = Preprocessor(classifier, input_shape=input_shape, batch_size=batch_size,
                                     augmentation=augmentation)
         neural_net = NeuralNet(input_shape, preprocessor=preprocessor, train=True)
     elif network_type == "rnn":
+        from nets.rnn import LSTMNet
+        from preprocess.sequencial import SequencialPreprocessor
         preprocessor = SequencialPreprocessor(classifier, input_shape=input_shape, batch_size=batch_size,
                                               augmentation=augmentation)("dataset/ck-split")
         neural_net = LSTMNet(input_shape, preprocessor=preprocessor, train=True)
     elif network_type == "drnn":
+        from nets.rnn import DlibLSTMNet
+        from preprocess.sequencial import DlibSequencialPreprocessor
         preprocessor = DlibSequencialPreprocessor(classifier, input_shape=input_shape, batch_size=batch_size,
                                                   augmentation=augmentation)("dataset/ck-split")
         neural_net = DlibLSTMNet(input_shape, preprocessor=preprocessor, train=True)
     elif network_type == "dinn":
+        from nets.dlib_inputs import DlibPointsInputNeuralNet
+        from preprocess.dlib_input import DlibInputPreprocessor
         preprocessor = DlibInputPreprocessor(classifier, input_shape=input_shape, batch_size=batch_size,
                                              augmentation=augmentation)
         neural_net = DlibPointsInputNeuralNet(input_shape, preprocessor=preprocessor, train=True)
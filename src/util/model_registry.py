@@ -0,0 +1,230 @@
+"""
+Process-wide registry of keras models loaded from json architecture and h5 weight files.
+"""
+from __future__ import print_function
+
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class ModelRegistry(object):
+    """
+    Loads each model once per process and hands the same instance to every caller. Models are keyed by the
+    real paths and modification times of their json and h5 files, so a model overwritten on disk is reloaded
+    and its stale entry released.
+
+    Models returned by the registry are shared: training or recompiling one affects every net using it.
+    """
+
+    def __init__(self):
+        """
+
+        """
+        self.models = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+        self.load_seconds = {}
+        self.model_bytes = {}
+        self.hits = {}
+
+    def key(self, json_path, h5_path):
+        """
+
+        Args:
+            json_path:
+            h5_path:
+
+        Returns:
+            (json path, json mtime, h5 path, h5 mtime)
+        """
+        json_path = os.path.realpath(json_path)
+        h5_path = os.path.realpath(h5_path)
+        return json_path, os.path.getmtime(json_path), h5_path, os.path.getmtime(h5_path)
+
+    def get(self, json_path, h5_path):
+        """
+        Returns the model of json_path and h5_path, loading it if no caller loaded the current files yet.
+
+        Args:
+            json_path:
+            h5_path:
+
+        Returns:
+            keras model
+        """
+        key = self.key(json_path, h5_path)
+        with self.lock:
+            if key in self.models:
+                self.hits[key] += 1
+                return self.models[key]
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.models:
+                    self.hits[key] += 1
+                    return self.models[key]
+            start_time = time.time()
+            model = self.load(json_path, h5_path)
+            load_seconds = time.time() - start_time
+            with self.lock:
+                for stale_key in [k for k in self.models if k[0] == key[0] and k[2] == key[2]]:
+                    self.release(stale_key)
+                self.models[key] = model
+                self.load_seconds[key] = load_seconds
+                self.model_bytes[key] = self.count_bytes(model)
+                self.hits[key] = 0
+                self.key_locks.pop(key, None)
+            print("Loaded model", json_path, "in", round(load_seconds, 2), "s")
+            return model
+
+    def load(self, json_path, h5_path):
+        """
+
+        Args:
+            json_path:
+            h5_path:
+
+        Returns:
+            keras model read from the files
+        """
+        from keras.models import model_from_json
+        with open(json_path) as json_file:
+            model = model_from_json(json_file.read())
+        model.load_weights(h5_path)
+        return model
+
+    def count_bytes(self, model):
+        """
+
+        Args:
+            model:
+
+        Returns:
+            number of bytes of the weights of model
+        """
+        from keras import backend as K
+        return int(sum(K.count_params(weight) * np.dtype(K.dtype(weight)).itemsize for weight in model.weights))
+
+    def release(self, key):
+        """
+        Forgets a model, it is freed once no net holds it anymore. The lock must be held by the caller.
+
+        Args:
+            key:
+        """
+        for entries in [self.models, self.load_seconds, self.model_bytes, self.hits]:
+            entries.pop(key, None)
+
+    def clear(self):
+        """
+        Forgets every model.
+        """
+        with self.lock:
+            for key in list(self.models.keys()):
+                self.release(key)
+
+    def stats(self):
+        """
+
+        Returns:
+            dict with the number of loaded models, their total weight bytes and load time, and per model the
+            load time, weight bytes and number of reuses
+        """
+        with self.lock:
+            models = [{"json_path": key[0], "h5_path": key[2], "load_seconds": self.load_seconds[key],
+                       "bytes": self.model_bytes[key], "hits": self.hits[key]} for key in self.models]
+        return {"models": len(models), "bytes": sum(model["bytes"] for model in models),
+                "load_seconds": sum(model["load_seconds"] for model in models), "per_model": models}
+
+
+class LazyModel(object):
+    """
+    Stands for a registry model until an attribute of it is used, the model is loaded at that point. Predicting,
+    reading layers or weights through the proxy therefore only loads models that are actually used.
+
+    parameters
+    ----------
+    json_path : str
+    h5_path : str
+    registry : ModelRegistry
+    """
+
+    def __init__(self, json_path, h5_path, registry=None):
+        """
+
+        Args:
+            json_path:
+            h5_path:
+            registry: defaults to the registry of the process
+        """
+        object.__setattr__(self, "json_path", json_path)
+        object.__setattr__(self, "h5_path", h5_path)
+        object.__setattr__(self, "registry", registry if registry is not None else default_registry)
+        object.__setattr__(self, "model", None)
+
+    def get(self):
+        """
+
+        Returns:
+            the loaded keras model
+        """
+        if self.model is None:
+            object.__setattr__(self, "model", self.registry.get(self.json_path, self.h5_path))
+        return self.model
+
+    def is_loaded(self):
+        """
+
+        Returns:
+            True once the model has been loaded
+        """
+        return self.model is not None
+
+    def __getattr__(self, name):
+        """
+
+        Args:
+            name: attribute of the keras model
+
+        Returns:
+
+        """
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        """
+
+        Args:
+            name: attribute of the keras model
+            value:
+        """
+        setattr(self.get(), name, value)
+
+
+default_registry = ModelRegistry()
+
+
+def lazy_model(model_path):
+    """
+
+    Args:
+        model_path: path of the model files without the .json and .h5 extensions
+
+    Returns:
+        LazyModel of the model shared through the registry of the process
+    """
+    return LazyModel(model_path + ".json", model_path + ".h5")
+
+
+def registry_stats():
+    """
+
+    Returns:
+        memory and load time statistics of the models loaded by this process
+    """
+    return default_registry.stats()
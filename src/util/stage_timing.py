@@ -0,0 +1,265 @@
+"""
+Named stage timers with fixed-size histograms, reporting periodic latency percentiles of the inference loop.
+"""
+from __future__ import print_function
+
+import json
+import math
+import sys
+import threading
+import time
+
+import numpy as np
+
+from config import STAGE_TIMING, STAGE_TIMING_INTERVAL, STAGE_TIMING_OUTPUT
+from util.BaseLogger import EmopyLogger
+
+
+class LatencyHistogram(object):
+    """
+    Counts durations in logarithmic buckets, each `growth` times wider than the previous one, from `min_seconds`
+    to `max_seconds`. Recording is one log and one increment whatever the number of samples, and percentiles are
+    exact up to the bucket width.
+
+    parameters
+    ----------
+    min_seconds : float
+    max_seconds : float
+    growth : float
+    """
+
+    def __init__(self, min_seconds=1e-6, max_seconds=100.0, growth=1.05):
+        """
+
+        Args:
+            min_seconds:
+            max_seconds:
+            growth:
+        """
+        self.min_seconds = min_seconds
+        self.log_growth = math.log(growth)
+        self.number_of_buckets = int(math.ceil(math.log(max_seconds / min_seconds) / self.log_growth)) + 1
+        self.upper_bounds = min_seconds * np.exp(self.log_growth * np.arange(1, self.number_of_buckets + 1))
+        self.counts = np.zeros(self.number_of_buckets, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        """
+
+        Args:
+            seconds:
+        """
+        if seconds <= self.min_seconds:
+            bucket = 0
+        else:
+            bucket = min(int(math.log(seconds / self.min_seconds) / self.log_growth), self.number_of_buckets - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """
+
+        Args:
+            q: percentile between 0 and 100
+
+        Returns:
+            upper bound in seconds of the bucket holding the q-th percentile, None if nothing was recorded
+        """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(q / 100.0 * self.count)))
+        return float(self.upper_bounds[np.searchsorted(np.cumsum(self.counts), rank)])
+
+    def reset(self):
+        """
+
+        """
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.0
+
+
+class _NullStage(object):
+    """
+    Context manager of disabled timers, shared by all of them.
+    """
+
+    def __enter__(self):
+        """
+
+        Returns:
+
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+
+        Returns:
+            False, exceptions propagate
+        """
+        return False
+
+
+class _Stage(object):
+    """
+    Context manager recording the time spent in its block.
+    """
+
+    def __init__(self, timers, name):
+        """
+
+        Args:
+            timers: StageTimers recording the duration
+            name:
+        """
+        self.timers = timers
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        """
+
+        Returns:
+
+        """
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+
+        Returns:
+            False, exceptions propagate
+        """
+        self.timers.record(self.name, time.time() - self.start_time)
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageTimers(object):
+    """
+    Histograms of named stages, e.g. `with timers.stage("detect"): ...`. Every `interval` seconds, checked when
+    `tick` is called once per frame, the p50/p95/p99 of every stage over the elapsed period are reported and the
+    histograms start over.
+
+    Disabled timers hand out a shared no-op context manager and `tick` returns immediately, so instrumented code
+    costs an attribute lookup and a call per stage.
+
+    parameters
+    ----------
+    enabled : bool
+    interval : float
+        seconds between two reports
+    output_path : str
+        json lines file receiving the reports, logged with the logger if None
+    logger : util.BaseLogger.EmopyLogger
+    """
+
+    def __init__(self, enabled=STAGE_TIMING, interval=STAGE_TIMING_INTERVAL, output_path=STAGE_TIMING_OUTPUT,
+                 logger=None):
+        """
+
+        Args:
+            enabled:
+            interval:
+            output_path:
+            logger: defaults to a logger printing to stdout
+        """
+        self.enabled = enabled
+        self.interval = interval
+        self.output_path = output_path
+        self.logger = logger if logger is not None else EmopyLogger([sys.stdout])
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.period_start = time.time()
+
+    def stage(self, name):
+        """
+
+        Args:
+            name:
+
+        Returns:
+            context manager timing its block as stage name
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        """
+
+        Args:
+            name: stage name
+            seconds: duration of one execution of the stage
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def tick(self):
+        """
+        Counts a frame and reports if the period is over.
+        """
+        if not self.enabled:
+            return
+        self.frames += 1
+        if time.time() - self.period_start >= self.interval:
+            self.report()
+
+    def summary(self):
+        """
+
+        Returns:
+            dict with the duration of the period, its frames per second and per stage the number of executions,
+            mean and percentiles in ms
+        """
+        elapsed = time.time() - self.period_start
+        with self.lock:
+            stages = {}
+            for name, histogram in self.histograms.items():
+                if histogram.count == 0:
+                    continue
+                stages[name] = {"count": histogram.count,
+                                "mean_ms": histogram.total / histogram.count * 1000,
+                                "p50_ms": histogram.percentile(50) * 1000,
+                                "p95_ms": histogram.percentile(95) * 1000,
+                                "p99_ms": histogram.percentile(99) * 1000}
+        return {"time": time.time(), "seconds": elapsed, "fps": self.frames / elapsed if elapsed > 0 else 0,
+                "stages": stages}
+
+    def report(self):
+        """
+        Writes the summary of the period and starts a new one.
+
+        Returns:
+            the summary
+        """
+        summary = self.summary()
+        if self.output_path is not None:
+            with open(self.output_path, "a") as output_file:
+                output_file.write(json.dumps(summary) + "\n")
+        else:
+            self.logger.log("Stage timings over " + str(round(summary["seconds"], 1)) + "s, " +
+                            str(round(summary["fps"], 2)) + " fps")
+            for name in sorted(summary["stages"]):
+                stage = summary["stages"][name]
+                self.logger.log("  {:<12} n={:<6} p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms".format(
+                    name, stage["count"], stage["p50_ms"], stage["p95_ms"], stage["p99_ms"]))
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+        self.frames = 0
+        self.period_start = time.time()
+        return summary
+
+
+timers = StageTimers()
@@ -0,0 +1,238 @@
+"""
+Offline emotion recognition on video files, staged as decode, face detection, batched classification and an
+optional annotated video writer connected by bounded queues.
+"""
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from util.stage_timing import timers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_END = object()
+
+
+class VideoPipeline(object):
+    """
+    Runs every stage in its own thread. The classifier gathers the faces of consecutive frames until it has
+    `batch_size` faces, or until no detected frame is waiting, and classifies them with one forward pass.
+
+    parameters
+    ----------
+    neural_net : nets.base.NeuralNet
+        net whose predict_batch classifies the faces
+    preprocessor : preprocess.base.Preprocessor
+        preprocessor used to find and sanitize the faces
+    face_detector : dlib.fhog_object_detector
+    postprocessor : util.BasePostprocessor.PostProcessor
+        draws the predictions on the frames written to output_path
+    batch_size : int
+        maximum number of faces per forward pass
+    queue_size : int
+        maximum number of frames waiting between two stages
+    """
+
+    def __init__(self, neural_net, preprocessor, face_detector, postprocessor=None, batch_size=32, queue_size=64):
+        """
+
+        Args:
+            neural_net:
+            preprocessor:
+            face_detector:
+            postprocessor:
+            batch_size:
+            queue_size:
+        """
+        self.neural_net = neural_net
+        self.preprocessor = preprocessor
+        self.face_detector = face_detector
+        self.postprocessor = postprocessor
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.fps = 0
+        self.error = None
+
+    def put(self, out_queue, item):
+        """
+        Blocking put that gives up once another stage failed.
+
+        Args:
+            out_queue:
+            item:
+        """
+        while self.error is None:
+            try:
+                out_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def run_stage(self, stage, args, out_queue):
+        """
+        Runs stage and always ends out_queue, recording the first error of any stage.
+
+        Args:
+            stage:
+            args: arguments of stage
+            out_queue: last argument of stage
+        """
+        try:
+            stage(*args)
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            try:
+                out_queue.put(_END, timeout=1.0)
+            except queue.Full:
+                pass
+
+    def decode(self, capture, frames):
+        """
+
+        Args:
+            capture: opened cv2.VideoCapture
+            frames: queue receiving (frame index, frame)
+        """
+        index = 0
+        while self.error is None:
+            with timers.stage("read"):
+                ret, frame = capture.read()
+            if not ret:
+                break
+            self.put(frames, (index, frame))
+            index += 1
+        capture.release()
+
+    def detect(self, frames, detections):
+        """
+
+        Args:
+            frames: queue of (frame index, frame)
+            detections: queue receiving (frame index, frame, rectangles, sanitized faces)
+        """
+        while self.error is None:
+            item = frames.get()
+            if item is _END:
+                return
+            index, frame = item
+            with timers.stage("detect"):
+                faces, rectangles = self.preprocessor.get_faces(frame, self.face_detector)
+            with timers.stage("sanitize"):
+                faces = [self.preprocessor.sanitize(face) for face in faces]
+            self.put(detections, (index, frame, rectangles, faces))
+
+    def classify(self, detections, results):
+        """
+
+        Args:
+            detections: queue of (frame index, frame, rectangles, sanitized faces)
+            results: queue receiving (frame index, frame, rectangles, predictions)
+        """
+        ended = False
+        while not ended and self.error is None:
+            pending = [detections.get()]
+            number_of_faces = 0
+            while pending[-1] is not _END:
+                number_of_faces += len(pending[-1][3])
+                if number_of_faces >= self.batch_size:
+                    break
+                try:
+                    pending.append(detections.get_nowait())
+                except queue.Empty:
+                    break
+            if pending[-1] is _END:
+                ended = True
+                pending = pending[:-1]
+            faces = [face for item in pending for face in item[3]]
+            with timers.stage("predict"):
+                predictions = self.neural_net.predict_batch(faces)
+            start = 0
+            for index, frame, rectangles, frame_faces in pending:
+                self.put(results, (index, frame, rectangles, predictions[start:start + len(frame_faces)]))
+                start += len(frame_faces)
+
+    def run(self, video_path, output_path=None, predictions_path=None):
+        """
+        Processes the whole video.
+
+        Args:
+            video_path: video file to analyse
+            output_path: annotated video written with the postprocessor, not written if None
+            predictions_path: per-frame predictions written as json lines, not written if None
+
+        Returns:
+            list of (frame index, rectangles, predictions) for every frame
+        """
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise Exception("Unable to open video " + str(video_path))
+        writer = None
+        if output_path is not None:
+            assert self.postprocessor is not None, "Writing an annotated video requires a postprocessor"
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            video_fps = capture.get(cv2.CAP_PROP_FPS) or 25
+            writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*"mp4v"), video_fps, (width, height))
+
+        frames = queue.Queue(maxsize=self.queue_size)
+        detections = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+        self.error = None
+        stages = [threading.Thread(target=self.run_stage, args=(self.decode, (capture, frames), frames)),
+                  threading.Thread(target=self.run_stage, args=(self.detect, (frames, detections), detections)),
+                  threading.Thread(target=self.run_stage, args=(self.classify, (detections, results), results))]
+        start_time = time.time()
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        frame_predictions = []
+        predictions_file = open(predictions_path, "w") if predictions_path is not None else None
+        try:
+            while True:
+                try:
+                    item = results.get(timeout=0.1)
+                except queue.Empty:
+                    if self.error is not None:
+                        break
+                    continue
+                if item is _END:
+                    break
+                index, frame, rectangles, predictions = item
+                predictions = np.asarray(predictions)
+                frame_predictions.append((index, rectangles, predictions))
+                if predictions_file is not None:
+                    predictions_file.write(json.dumps({
+                        "frame": index,
+                        "faces": [{"rectangle": [r.left(), r.top(), r.right(), r.bottom()],
+                                   "predictions": p.tolist()} for r, p in zip(rectangles, predictions)]}) + "\n")
+                if writer is not None:
+                    with timers.stage("overlay"):
+                        self.postprocessor(frame, rectangles, predictions)
+                    with timers.stage("write"):
+                        writer.write(frame)
+                timers.tick()
+        finally:
+            if predictions_file is not None:
+                predictions_file.close()
+            if writer is not None:
+                writer.release()
+        for stage in stages:
+            stage.join(1.0)
+        if self.error is not None:
+            raise self.error
+
+        elapsed = time.time() - start_time
+        self.fps = len(frame_predictions) / elapsed if elapsed > 0 else 0
+        print("Processed", len(frame_predictions), "frames in", round(elapsed, 2), "s:", round(self.fps, 2), "fps")
+        return frame_predictions
@@ -1,11 +1,13 @@
 import json
 import os
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import numpy as np
-from keras.models import model_from_json, Model
+from keras.models import Model
 
-from visualization.json_helpers import JsonLayer
+from util.model_registry import LazyModel
+from visualization.json_helpers import AtlasLayer
 
 
 def load_model(json_path, h5_path):
@@ -16,12 +18,9 @@ def load_model(json_path, h5_path):
         h5_path:
 
     Returns:
-
+        util.model_registry.LazyModel, shared with the nets loading the same files
     """
-    with open(json_path) as json_file:
-        model = model_from_json(json_file.read())
-        model.load_weights(h5_path)
-        return model
+    return LazyModel(json_path, h5_path)
 
 
 def get_feature_images(layer_features):
@@ -31,20 +30,17 @@ def get_feature_images(layer_features):
         layer_features:
 
     Returns:
-
+        feature images of the layer, None for 3D layers which have none
     """
     if len(layer_features.shape) == 2:
-        if layer_features.shape[1] < 100:
-            print(layer_features)
         output = np.tile(layer_features, (50, 1))
 
         output = (output * 255).astype(np.uint8)
         if output.shape[1] < 100:
-            print(output.shape)
             output = cv2.resize(output, (50, 100))
         return output.reshape(1, 50, -1)
     elif len(layer_features.shape) == 3:
-        print("layer is 3D")
+        return None
     elif len(layer_features.shape) == 4:
         clf_shape = layer_features.shape
         if clf_shape[1] > 30:
@@ -65,23 +61,6 @@ def get_feature_images(layer_features):
         raise Exception("get feature images not implmented for layer with shape: " + str(layer_features.shape))
 
 
-def generate_layer_features(input_layer, current_layer, image):
-    """
-
-    Args:
-        input_layer:
-        current_layer:
-        image:
-
-    Returns:
-
-    """
-    current_layer_model = Model(inputs=input_layer, outputs=current_layer.output)
-    current_layer_features = current_layer_model.predict(image)
-    output_images = get_feature_images(current_layer_features)
-    return output_images
-
-
 def replace_non_alphanumeric(string, c):
     """
 
@@ -101,42 +80,178 @@ def replace_non_alphanumeric(string, c):
     return output
 
 
-def generate_features(model, image, output_dir):
+def get_activation_model(model):
+    """
+    Model computing the outputs of every layer of model, so all activations come from one forward pass instead
+    of one truncated model and prediction per layer.
+
+    Args:
+        model: keras model
+
+    Returns:
+        keras.models.Model with one output per layer of model
+    """
+    return Model(inputs=model.input, outputs=[layer.output for layer in model.layers])
+
+
+def generate_activations(model, images, activation_model=None):
     """
 
+    Args:
+        model: keras model
+        images: float images of shape (N, height, width) or (N, height, width, 1)
+        activation_model: model returned by get_activation_model(model), built if None
+
+    Returns:
+        list with, for every layer of model, its activations of the N images
+    """
+    if activation_model is None:
+        activation_model = get_activation_model(model)
+    images = np.asarray(images)
+    images = images.reshape(-1, images.shape[1], images.shape[2], 1)
+    activations = activation_model.predict(images, batch_size=len(images))
+    if not isinstance(activations, list):
+        activations = [activations]
+    return activations
+
+
+def generate_features(model, images, output_dirs, output_format="sprites", workers=4):
+    """
+    Writes the activations of every layer for each image as a packed atlas with its index.json, see
+    write_sprites and write_activations.
+
     Args:
         model:
-        image:
+        images: float image of shape (height, width), or batch of them
+        output_dirs: output directory of the image, or list with one output directory per image
+        output_format: "sprites" for one tiled png per layer, "memmap" for one raw float32 file per image
+        workers: threads writing the files in the background
+    """
+    assert output_format in ["sprites", "memmap"], "Atlas format must be either sprites or memmap"
+    images = np.asarray(images)
+    if images.ndim == 2:
+        images = images[np.newaxis]
+    if not isinstance(output_dirs, (list, tuple)):
+        output_dirs = [output_dirs]
+    assert len(output_dirs) == len(images), "Every image needs its output directory"
+    activations = generate_activations(model, images)
+    layer_names = [replace_non_alphanumeric(layer.name, "_") for layer in model.layers]
+    pool = ThreadPool(workers)
+    writes = []
+    try:
+        for image_index, output_dir in enumerate(output_dirs):
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            image_activations = [layer_activations[image_index:image_index + 1] for layer_activations in activations]
+            if output_format == "sprites":
+                index = write_sprites(layer_names, image_activations, output_dir, pool, writes)
+            else:
+                index = write_activations(layer_names, image_activations, output_dir, pool, writes)
+            with open(os.path.join(output_dir, "index.json"), "w") as index_file:
+                json.dump({"format": output_format, "layers": [layer.__dict__ for layer in index]}, index_file)
+        # raises the first error of the background writes
+        for write in writes:
+            write.get()
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def tile(feature_images):
+    """
+
+    Args:
+        feature_images: array of shape (number of images, height, width)
+
+    Returns:
+        sprite sheet of the images in a grid of ceil(sqrt(number of images)) columns, and the number of columns
+    """
+    count, height, width = feature_images.shape
+    columns = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / float(columns)))
+    sheet = np.zeros((rows * height, columns * width), dtype=np.uint8)
+    for i in range(count):
+        row, column = divmod(i, columns)
+        sheet[row * height:(row + 1) * height, column * width:(column + 1) * width] = feature_images[i]
+    return sheet, columns
+
+
+def write_sprites(layer_names, activations, output_dir, pool, writes):
+    """
+    Tiles the feature images of every layer into one png, feature i is the tile at column i % columns and row
+    i // columns.
+
+    Args:
+        layer_names:
+        activations: activations of one image for every layer, each with a batch dimension of one
         output_dir:
+        pool: thread pool writing the pngs
+        writes: list receiving the AsyncResult of every write
+
+    Returns:
+        list of AtlasLayer
+    """
+    index = []
+    for layer_name, layer_activations in zip(layer_names, activations):
+        feature_images = get_feature_images(layer_activations)
+        if feature_images is None:
+            continue
+        feature_images = np.asarray(feature_images).astype(np.uint8)
+        sheet, columns = tile(feature_images)
+        sprite = layer_name + ".png"
+        writes.append(pool.apply_async(write_image, (os.path.join(output_dir, sprite), sheet)))
+        index.append(AtlasLayer(layer_name, sprite, count=len(feature_images), columns=columns,
+                                tile_width=feature_images.shape[2], tile_height=feature_images.shape[1]))
+    return index
+
+
+def write_activations(layer_names, activations, output_dir, pool, writes):
+    """
+    Writes the raw activations of every layer one after the other into activations.bin, readable with
+    numpy.memmap at the offsets of the index.
+
+    Args:
+        layer_names:
+        activations: activations of one image for every layer, each with a batch dimension of one
+        output_dir:
+        pool: thread pool writing the file
+        writes: list receiving the AsyncResult of the write
+
+    Returns:
+        list of AtlasLayer
+    """
+    index = []
+    offset = 0
+    arrays = []
+    for layer_name, layer_activations in zip(layer_names, activations):
+        array = np.ascontiguousarray(layer_activations[0], dtype=np.float32)
+        index.append(AtlasLayer(layer_name, "activations.bin", offset=offset, shape=list(array.shape),
+                                dtype="float32"))
+        offset += array.nbytes
+        arrays.append(array)
+    writes.append(pool.apply_async(write_arrays, (os.path.join(output_dir, "activations.bin"), arrays)))
+    return index
+
+
+def write_image(path, image):
+    """
+
+    Args:
+        path:
+        image:
+    """
+    if not cv2.imwrite(path, image):
+        raise Exception("Unable to write " + path)
+
+
+def write_arrays(path, arrays):
+    """
+
+    Args:
+        path:
+        arrays: arrays written one after the other
     """
-    input_layer = model.input
-    image_shape = image.shape
-    image = image.reshape(-1, image_shape[0], image_shape[1], 1)
-    json_layers = []
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    for i in range(len(model.layers)):
-        layer = model.layers[i]
-        layer_name = layer.name
-        layer_features = generate_layer_features(input_layer, layer, image)
-        layer_name = replace_non_alphanumeric(layer_name, "_")
-        if not os.path.exists(os.path.join(output_dir, layer_name)):
-            os.makedirs(os.path.join(output_dir, layer_name))
-        if layer_features is not None:
-            layer_image_paths = []
-            for j in range(len(layer_features)):
-                img = layer_features[j]
-                img = np.array(img)
-                layer_image_paths.append("f" + str(j) + ".png")
-                cv2.imwrite(os.path.join(output_dir, layer_name, "f" + str(j) + ".png"), img)
-            json_layers.append(JsonLayer(layer_name, layer_image_paths))
-
-    json_string = json.dumps([ob.__dict__ for ob in json_layers])
-    with open("/home/mtk/iCog/projects/visualization/nodejs/emopy/test.json", "w+") as test_file:
-        test_file.write(json_string)
-
-
-        # json.dump(json_layers, codecs.open("test.json", 'w', encoding='utf-8'), separators=(',', ':'), sort_keys=True, indent=4)
-
-        # print layer1_features.shape
+    with open(path, "wb") as output_file:
+        for array in arrays:
+            output_file.write(array.tobytes())
@@ -31,11 +31,15 @@ emg_emotions = {"/home/mtk/iCog/projects/emopy/dataset/ck/train/anger/S011_004_0
                 "/home/mtk/iCog/projects/emopy/dataset/ck/test/neutral/S011_004_00000001.png": "neutral"
 
                 }
+images = []
+output_dirs = []
 for img_file in emg_emotions:
     print(img_file)
     img = cv2.imread(img_file)
     img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     img = cv2.resize(img, (48, 48))
-    img = img.astype(np.float32) / 255
+    images.append(img.astype(np.float32) / 255)
+    output_dirs.append("/home/mtk/iCog/projects/visualization/nodejs/emopy/" + emg_emotions[img_file])
 
-    generate_features(model, img, "/home/mtk/iCog/projects/visualization/nodejs/emopy/" + emg_emotions[img_file])
+# all faces go through the net in one forward pass
+generate_features(model, np.array(images), output_dirs)
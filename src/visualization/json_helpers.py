@@ -1,13 +1,18 @@
-class JsonLayer(object):
+class AtlasLayer(object):
     """
+    Index entry of a layer in an activation atlas. Sprite layers record their tile grid, memmap layers the byte
+    offset, shape and dtype of their activations in the shared file.
     """
 
-    def __init__(self, name, images_relative_path):
+    def __init__(self, name, path, **location):
         """
 
         Args:
-            name:
-            images_relative_path:
+            name: layer name
+            path: file holding the layer, relative to the index
+            location: count, columns, tile_width and tile_height of a sprite, or offset, shape and dtype of
+                raw activations
         """
         self.name = name
-        self.images_relative_path = images_relative_path
+        self.path = path
+        self.__dict__.update(location)
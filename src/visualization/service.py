@@ -0,0 +1,317 @@
+"""
+Local HTTP service computing layer activations on demand for the visualization frontend.
+
+    POST /images                                    encoded image as body, answers {"image": image id}
+    GET  /models                                    answers the layer names of every served model
+    GET  /activations?model=&image=&layer=          sprite sheet png of the layer, its grid in X-Atlas-* headers
+    GET  /activations?model=&image=&layer=&format=json
+                                                    the AtlasLayer entry of the layer
+    GET  /metrics                                   cache statistics
+
+The activations of all layers come from one forward pass, cached per model and image, so switching layers only
+tiles already computed activations.
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from inference_server import ThreadingHTTPServer, read_body
+from visualization import load_model, get_activation_model, get_feature_images, replace_non_alphanumeric, tile
+from visualization.json_helpers import AtlasLayer
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import urlparse, parse_qs
+
+
+class ActivationService(object):
+    """
+    Serves the activations of a set of models. Uploaded images and forward passes are kept in LRU caches of
+    `max_images` and `max_passes` entries, forward passes being keyed by model name and image id.
+
+    Models and their multi-output activation models are built when the service starts. The caches are guarded by
+    a lock which is released during forward passes, so cache hits are answered while passes run. Concurrent
+    requests for the same model and image wait for the pass in flight instead of computing it again.
+
+    parameters
+    ----------
+    model_paths : dict
+        model name to model path without the .json and .h5 extensions
+    max_images : int
+    max_passes : int
+    """
+
+    def __init__(self, model_paths, max_images=256, max_passes=64):
+        """
+
+        Args:
+            model_paths:
+            max_images:
+            max_passes:
+        """
+        self.models = {}
+        self.activation_models = {}
+        for name, path in model_paths.items():
+            self.models[name] = load_model(path + ".json", path + ".h5").get()
+            self.activation_models[name] = get_activation_model(self.models[name])
+            # keras 2 builds the predict function on first use, which is not safe from concurrent request threads
+            if hasattr(self.activation_models[name], "_make_predict_function"):
+                self.activation_models[name]._make_predict_function()
+        self.max_images = max_images
+        self.max_passes = max_passes
+        self.images = OrderedDict()
+        self.passes = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add_image(self, image):
+        """
+
+        Args:
+            image: decoded BGR or gray image
+
+        Returns:
+            id of the image, the sha1 of its pixels
+        """
+        image_id = hashlib.sha1(np.ascontiguousarray(image).tobytes() + str(image.shape).encode("utf-8")).hexdigest()
+        with self.lock:
+            self.images.pop(image_id, None)
+            self.images[image_id] = image
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return image_id
+
+    def get_layer_names(self, model_name):
+        """
+
+        Args:
+            model_name:
+
+        Returns:
+            names of the layers of the model, as used in requests
+        """
+        return [replace_non_alphanumeric(layer.name, "_") for layer in self.models[model_name].layers]
+
+    def prepare(self, model_name, image):
+        """
+
+        Args:
+            model_name:
+            image: decoded BGR or gray image
+
+        Returns:
+            image as expected by the model: gray, resized to its input size and scaled to [0, 1]
+        """
+        height, width = self.models[model_name].input_shape[1:3]
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        image = cv2.resize(image, (width, height))
+        return image.astype(np.float32).reshape(1, height, width, 1) / 255
+
+    def get_activations(self, model_name, image_id):
+        """
+
+        Args:
+            model_name:
+            image_id:
+
+        Returns:
+            activations of every layer of the model for the image, from the cache when possible
+        """
+        key = (model_name, image_id)
+        while True:
+            with self.lock:
+                activations = self.passes.pop(key, None)
+                if activations is not None:
+                    self.passes[key] = activations
+                    self.hits += 1
+                    return activations
+                if model_name not in self.models:
+                    raise KeyError("Unknown model " + model_name)
+                if image_id not in self.images:
+                    raise KeyError("Unknown image " + image_id)
+                done = self.in_flight.get(key)
+                if done is None:
+                    done = self.in_flight[key] = threading.Event()
+                    image = self.images[image_id]
+                    self.misses += 1
+                    break
+            # the pass is cached once done is set, unless it failed, then the next loop computes it again
+            done.wait()
+
+        try:
+            activations = self.activation_models[model_name].predict(self.prepare(model_name, image))
+            if not isinstance(activations, list):
+                activations = [activations]
+            with self.lock:
+                self.passes[key] = activations
+                while len(self.passes) > self.max_passes:
+                    self.passes.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
+        return activations
+
+    def get_layer_sprite(self, model_name, image_id, layer_name):
+        """
+
+        Args:
+            model_name:
+            image_id:
+            layer_name:
+
+        Returns:
+            sprite sheet of the feature images of the layer and its AtlasLayer entry
+        """
+        layer_names = self.get_layer_names(model_name) if model_name in self.models else []
+        if layer_name not in layer_names:
+            raise KeyError("Unknown layer " + layer_name)
+        activations = self.get_activations(model_name, image_id)[layer_names.index(layer_name)]
+        feature_images = get_feature_images(activations)
+        if feature_images is None:
+            raise KeyError("Layer " + layer_name + " has no feature images")
+        feature_images = np.asarray(feature_images).astype(np.uint8)
+        sheet, columns = tile(feature_images)
+        return sheet, AtlasLayer(layer_name, layer_name + ".png", count=len(feature_images), columns=columns,
+                                 tile_width=feature_images.shape[2], tile_height=feature_images.shape[1])
+
+    def stats(self):
+        """
+
+        Returns:
+            dict of the cache statistics
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "passes": len(self.passes),
+                    "images": len(self.images), "in_flight": len(self.in_flight), "max_passes": self.max_passes,
+                    "max_images": self.max_images}
+
+
+class ActivationRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of the activation service, `server.service` is the ActivationService.
+    """
+
+    def send(self, status, body, content_type, headers=None):
+        """
+
+        Args:
+            status: http status code
+            body: bytes
+            content_type:
+            headers: dict of additional headers
+        """
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, content):
+        """
+
+        Args:
+            status:
+            content: json serializable answer
+        """
+        self.send(status, json.dumps(content).encode("utf-8"), "application/json")
+
+    def do_POST(self):
+        """
+        Stores an uploaded image.
+        """
+        if urlparse(self.path).path != "/images":
+            self.send_json(404, {"error": "Unknown path " + self.path})
+            return
+        try:
+            body = read_body(self)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        # the models take gray input, decoding to 8 bit gray also accepts rgba and 16 bit images
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            self.send_json(400, {"error": "Body is not an encoded image"})
+            return
+        self.send_json(200, {"image": self.server.service.add_image(image)})
+
+    def do_GET(self):
+        """
+        Answers the models, metrics or layer activations.
+        """
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == "/models":
+            self.send_json(200, {name: service.get_layer_names(name) for name in service.models})
+        elif url.path == "/metrics":
+            self.send_json(200, service.stats())
+        elif url.path == "/activations":
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                sheet, atlas_layer = service.get_layer_sprite(query.get("model", ""), query.get("image", ""),
+                                                              query.get("layer", ""))
+            except KeyError as e:
+                self.send_json(404, {"error": str(e).strip("'")})
+                return
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+            if query.get("format") == "json":
+                self.send_json(200, atlas_layer.__dict__)
+                return
+            self.send(200, cv2.imencode(".png", sheet)[1].tobytes(), "image/png",
+                      {"X-Atlas-Count": atlas_layer.count, "X-Atlas-Columns": atlas_layer.columns,
+                       "X-Atlas-Tile-Width": atlas_layer.tile_width, "X-Atlas-Tile-Height": atlas_layer.tile_height})
+        else:
+            self.send_json(404, {"error": "Unknown path " + self.path})
+
+    def log_message(self, format, *args):
+        """
+        Layer switches are too frequent to be logged.
+        """
+        pass
+
+
+def main():
+    """
+    Starts the service.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, type=str, nargs="+",
+                        help="name=path pairs, the path without the .json and .h5 extensions")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8001, type=int)
+    parser.add_argument("--max_images", default=256, type=int)
+    parser.add_argument("--max_passes", default=64, type=int)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), ActivationRequestHandler)
+    server.service = ActivationService(dict(model.split("=", 1) for model in args.model), args.max_images,
+                                       args.max_passes)
+    print("Serving activations on http://" + args.host + ":" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()